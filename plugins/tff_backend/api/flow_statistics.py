@@ -35,7 +35,7 @@ def api_list_flow_runs(flow_name=None, min_date=None, cursor=None, page_size=50)
     return {
         'cursor': cursor and cursor.to_websafe_string(),
         'more': more,
-        'results': [r.to_dict(exclude={'steps'}) for r in results]
+        'results': [r.to_dict() for r in results]
     }
 
 
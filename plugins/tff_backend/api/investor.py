@@ -23,12 +23,13 @@ from mcfw.rpc import returns, arguments
 from plugins.tff_backend.bizz.audit.audit import audit
 from plugins.tff_backend.bizz.audit.mapping import AuditLogType
 from plugins.tff_backend.bizz.authentication import Scopes
+from plugins.tff_backend.bizz.investment_stats import list_investment_agreement_stats
 from plugins.tff_backend.bizz.investor import put_investment_agreement, create_investment_agreement
 from plugins.tff_backend.bizz.iyo.utils import get_app_user_from_iyo_username
 from plugins.tff_backend.dal.investment_agreements import search_investment_agreements, get_investment_agreement, \
     list_investment_agreements_by_user
 from plugins.tff_backend.to.investor import InvestmentAgreementListTO, InvestmentAgreementTO, \
-    CreateInvestmentAgreementTO, InvestmentAgreementDetailTO
+    CreateInvestmentAgreementTO, InvestmentAgreementDetailTO, InvestmentAgreementDailyStatsTO
 from plugins.tff_backend.utils.search import sanitise_search_query
 
 
@@ -52,7 +53,15 @@ def api_create_investment_agreement(data):
     return InvestmentAgreementDetailTO.from_dict(create_investment_agreement(data).to_dict(['username']))
 
 
-@rest('/investment-agreements/<agreement_id:[^/]+>', 'get', Scopes.BACKEND_ADMIN)
+@rest('/investment-agreements/stats', 'get', Scopes.BACKEND_ADMIN, silent_result=True)
+@returns([InvestmentAgreementDailyStatsTO])
+@arguments(start_date=unicode, end_date=unicode)
+def api_get_investment_agreement_stats(start_date=None, end_date=None):
+    return [InvestmentAgreementDailyStatsTO.from_model(stats)
+            for stats in list_investment_agreement_stats(start_date, end_date)]
+
+
+@rest('/investment-agreements/<agreement_id:\d+>', 'get', Scopes.BACKEND_ADMIN)
 @returns(InvestmentAgreementDetailTO)
 @arguments(agreement_id=(int, long))
 def api_get_investment_agreement(agreement_id):
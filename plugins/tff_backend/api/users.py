@@ -24,11 +24,12 @@ from plugins.tff_backend.bizz.audit.mapping import AuditLogType
 from plugins.tff_backend.bizz.authentication import Scopes
 from plugins.tff_backend.bizz.flow_statistics import list_flow_runs_by_user
 from plugins.tff_backend.bizz.iyo.utils import get_app_user_from_iyo_username
-from plugins.tff_backend.bizz.payment import get_pending_transactions, get_all_balances
+from plugins.tff_backend.bizz.payment import get_pending_transactions, get_all_balances, get_balances, \
+    list_token_holder_balances
 from plugins.tff_backend.bizz.user import get_tff_profile, set_kyc_status, list_kyc_checks, set_utility_bill_verified, \
     search_tff_profiles
 from plugins.tff_backend.to.payment import PendingTransactionListTO, \
-    WalletBalanceTO
+    WalletBalanceTO, UserBalancesTO, UserBalancesListTO, BalancesQueryTO
 from plugins.tff_backend.to.user import SetKYCPayloadTO, TffProfileTO
 from plugins.tff_backend.utils.search import sanitise_search_query
 
@@ -86,6 +87,24 @@ def api_get_balance(username):
     return get_all_balances(username)
 
 
+@rest('/balances', 'get', Scopes.BACKEND_ADMIN, silent_result=True)
+@returns(UserBalancesListTO)
+@arguments(page_size=(int, long), cursor=unicode)
+def api_list_token_holder_balances(page_size=100, cursor=None):
+    balances, cursor, more = list_token_holder_balances(cursor, page_size)
+    results = [UserBalancesTO(username=username, balances=user_balances)
+               for username, user_balances in sorted(balances.iteritems())]
+    return UserBalancesListTO(cursor and cursor.to_websafe_string().decode('utf-8'), more, results)
+
+
+@rest('/balances', 'post', Scopes.BACKEND_ADMIN, silent_result=True)
+@returns([UserBalancesTO])
+@arguments(data=BalancesQueryTO)
+def api_get_balances(data):
+    balances = get_balances(data.usernames)
+    return [UserBalancesTO(username=username, balances=balances[username]) for username in data.usernames]
+
+
 @rest('/users/<username:[^/]+>/kyc/checks', 'get', Scopes.BACKEND_READONLY, silent_result=True)
 @returns([dict])
 @arguments(username=str)
@@ -103,5 +122,5 @@ def api_list_flow_runs_by_user(username=None, cursor=None, page_size=50):
     return {
         'cursor': cursor and cursor.to_websafe_string(),
         'more': more,
-        'results': [r.to_dict(exclude={'steps'}) for r in results]
+        'results': [r.to_dict() for r in results]
     }
@@ -17,6 +17,7 @@
 
 import codecs
 import os
+import threading
 import time
 
 import jinja2
@@ -26,7 +27,7 @@ import markdown
 from babel.numbers import get_currency_name
 from framework.utils import azzert
 from mcfw.rpc import returns, arguments
-from plugins.tff_backend.bizz.global_stats import get_global_stats
+from plugins.tff_backend.bizz.global_stats import get_cached_global_stats
 from plugins.tff_backend.consts.agreements import BANK_ACCOUNTS
 from plugins.tff_backend.consts.payment import TOKEN_ITFT
 from plugins.tff_backend.models.investor import PaymentInfo, InvestmentAgreement
@@ -39,7 +40,25 @@ except ImportError:
     from StringIO import StringIO
 
 ASSETS_FOLDER = os.path.join(os.path.dirname(__file__), 'assets')
-JINJA_ENVIRONMENT = jinja2.Environment(loader=jinja2.FileSystemLoader([ASSETS_FOLDER]))
+# The templates never change while the app is running, so there's no need to check if they have to be recompiled
+JINJA_ENVIRONMENT = jinja2.Environment(loader=jinja2.FileSystemLoader([ASSETS_FOLDER]), auto_reload=False)
+
+_bank_account_info = {}
+_currency_messages = None
+# Markdown and inflect engines are expensive to create but not thread safe
+_thread_local = threading.local()
+
+
+def _markdown_to_html(md):
+    if not hasattr(_thread_local, 'markdown'):
+        _thread_local.markdown = markdown.Markdown(extensions=['markdown.extensions.tables'])
+    return _thread_local.markdown.reset().convert(md)
+
+
+def _number_to_words(number):
+    if not hasattr(_thread_local, 'inflect_engine'):
+        _thread_local.inflect_engine = inflect.engine()
+    return _thread_local.inflect_engine.number_to_words(number)
 
 
 def _get_effective_date(t=None):
@@ -71,15 +90,17 @@ def get_bank_account_info(currency_short, payment_info, has_verified_utility_bil
     if payment_info and PaymentInfo.UAE.value in payment_info or not has_verified_utility_bill:
         suffix = 'default'
 
-    bank_file = os.path.join(ASSETS_FOLDER, 'bank_%s.md' % suffix)
-    with codecs.open(bank_file, 'r', encoding='utf-8') as f:
-        return f.read()
+    if suffix not in _bank_account_info:
+        bank_file = os.path.join(ASSETS_FOLDER, 'bank_%s.md' % suffix)
+        with codecs.open(bank_file, 'r', encoding='utf-8') as f:
+            _bank_account_info[suffix] = f.read()
+    return _bank_account_info[suffix]
 
 
 def create_itft_amendment_1_pdf(username):
     from plugins.tff_backend.bizz.investor import get_total_token_count
     agreements = InvestmentAgreement.list_by_status_and_user(username, [InvestmentAgreement.STATUS_PAID,
-                                                                        InvestmentAgreement.STATUS_SIGNED])
+                                                                        InvestmentAgreement.STATUS_SIGNED]).fetch()
     azzert(agreements)
     agreements.sort(key=lambda a: a.sign_time)
     purchase_amounts = ''
@@ -109,7 +130,7 @@ def create_itft_amendment_1_pdf(username):
     }
 
     md = JINJA_ENVIRONMENT.get_template('itft_amendment_1.md').render(template_variables)
-    markdown_to_html = markdown.markdown(md, extensions=['markdown.extensions.tables'])
+    markdown_to_html = _markdown_to_html(md)
     template_variables['markdown_to_html'] = markdown_to_html.replace('<th', '<td')
     return _render_pdf_from_html('token_itft.html', template_variables)
 
@@ -123,7 +144,7 @@ def create_token_agreement_pdf(full_name, address, amount, currency_full, curren
         return '{:.2f}'.format(x)
 
     amount_formatted = fmt(amount, currency_short)
-    stats = get_global_stats(token)
+    stats = get_cached_global_stats(token)
     conversion = {currency.currency: fmt(round_currency_amount(currency.currency, currency.value / stats.value),
                                          currency.currency)
                   for currency in stats.currencies}
@@ -136,7 +157,7 @@ def create_token_agreement_pdf(full_name, address, amount, currency_full, curren
         'amount': amount_formatted,
         'currency_full': currency_full,
         'price': stats.value,
-        'price_words': inflect.engine().number_to_words(stats.value).title(),
+        'price_words': _number_to_words(stats.value).title(),
         'currency_short': currency_short,
         'conversion': conversion
     }
@@ -146,10 +167,19 @@ def create_token_agreement_pdf(full_name, address, amount, currency_full, curren
         context = {'bank_account': get_bank_account_info(currency_short, payment_info or [], has_verified_utility_bill)}
         context.update(template_variables)
         md = JINJA_ENVIRONMENT.get_template('token_itft.md').render(context)
-        markdown_to_html = markdown.markdown(md, extensions=['markdown.extensions.tables'])
+        markdown_to_html = _markdown_to_html(md)
         template_variables['markdown_to_html'] = markdown_to_html.replace('<th', '<td')
         template_variables['title'] = u'iTFT Purchase Agreement'
     else:
+        template_variables['currency_messages'] = _get_currency_messages()
+        html_file = 'token_tft_btc.html' if currency_short == 'BTC' else 'token_tft.html'
+
+    return _render_pdf_from_html(html_file, template_variables)
+
+
+def _get_currency_messages():
+    global _currency_messages
+    if _currency_messages is None:
         currency_messages = []
         for currency in BANK_ACCOUNTS:
             account = BANK_ACCOUNTS[currency]
@@ -161,11 +191,8 @@ def create_token_agreement_pdf(full_name, address, amount, currency_full, curren
                 currency_messages.append(
                     u'when using %s: to the Company’s bank account at Mashreq Bank, IBAN: <b>%s</b> SWIFT/BIC:'
                     u' <b>BOMLAEAD</b>' % (get_currency_name(currency, locale='en_GB'), account))
-
-        template_variables['currency_messages'] = currency_messages
-        html_file = 'token_tft_btc.html' if currency_short == 'BTC' else 'token_tft.html'
-
-    return _render_pdf_from_html(html_file, template_variables)
+        _currency_messages = currency_messages
+    return _currency_messages
 
 
 def _render_pdf_from_html(html_file, template_variables):
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.4@@
+import hashlib
+import logging
+
+from google.appengine.ext import deferred
+
+from plugins.tff_backend.bizz.gcs import upload_to_gcs, get_gcs_file_info, get_serving_url
+from plugins.tff_backend.plugin_consts import PDF_RENDER_QUEUE
+from plugins.tff_backend.utils import StageTimer
+
+
+class PdfType(object):
+    TOKEN_AGREEMENT = 'token_agreement'
+    HOSTING_AGREEMENT = 'hosting_agreement'
+    ITFT_AMENDMENT_1 = 'itft_amendment_1'
+
+
+# Increment the version of a type when its template changes so existing documents are rendered again
+PDF_VERSIONS = {
+    PdfType.TOKEN_AGREEMENT: 1,
+    PdfType.HOSTING_AGREEMENT: 1,
+    PdfType.ITFT_AMENDMENT_1: 1,
+}
+
+_HASH_METADATA = 'x-goog-meta-pdf-hash'
+
+
+def schedule_pdf_render(pdf_type, document_id, filename, render, render_args, callback, callback_args,
+                        transactional=False):
+    # type: (str, object, unicode, callable, list, callable, list, bool) -> None
+    """
+    Renders a pdf with render_pdf on the pdf render queue. Only the rendering runs on that queue: once the pdf has
+    been uploaded, `callback` is deferred on the default queue with callback_args followed by the url and size of
+    the pdf.
+    """
+    deferred.defer(_render_pdf_and_defer_callback, pdf_type, document_id, filename, render, render_args, callback,
+                   callback_args, _queue=PDF_RENDER_QUEUE, _transactional=transactional)
+
+
+def _render_pdf_and_defer_callback(pdf_type, document_id, filename, render, render_args, callback, callback_args):
+    pdf_url, pdf_size = render_pdf(pdf_type, document_id, filename, render, *render_args)
+    deferred.defer(callback, *(list(callback_args) + [pdf_url, pdf_size]))
+
+
+def render_pdf(pdf_type, document_id, filename, render, *args):
+    # type: (str, object, unicode, callable, list) -> tuple[unicode, long]
+    """
+    Renders a pdf and uploads it to cloudstorage, unless a pdf with the same version and arguments has already been
+    uploaded.
+    Returns:
+        tuple: the url and the size of the pdf
+    """
+    inputs_hash = _get_inputs_hash(pdf_type, args)
+    file_info = get_gcs_file_info(filename)
+    if file_info and (file_info.metadata or {}).get(_HASH_METADATA) == inputs_hash:
+        logging.info('Not rendering %s %s again, it has already been rendered with the same arguments', pdf_type,
+                     document_id)
+        return get_serving_url(filename), file_info.st_size
+    timer = StageTimer('Rendering %s %s' % (pdf_type, document_id))
+    pdf_contents = render(*args)
+    timer.mark('render')
+    url = upload_to_gcs(filename, pdf_contents, 'application/pdf', options={_HASH_METADATA: inputs_hash})
+    timer.mark('upload')
+    timer.log()
+    return url, len(pdf_contents)
+
+
+def _get_inputs_hash(pdf_type, args):
+    return hashlib.sha1(repr((pdf_type, PDF_VERSIONS[pdf_type], args))).hexdigest()
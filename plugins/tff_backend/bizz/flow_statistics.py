@@ -14,9 +14,15 @@
 # limitations under the License.
 #
 # @@license_version:1.4@@
+import csv
+import gzip
+import hashlib
 import logging
+import pickle
+import time
 from datetime import datetime
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb, deferred
 
 import dateutil
@@ -24,24 +30,29 @@ from dateutil import relativedelta
 from framework.bizz.job import run_job
 from framework.consts import get_base_url
 from framework.utils import try_or_defer
+from mcfw.cache import cached, invalidate_cache
 from mcfw.exceptions import HttpNotFoundException
 from mcfw.properties import object_factory
-from mcfw.rpc import arguments, parse_complex_value
+from mcfw.rpc import arguments, parse_complex_value, returns
 from plugins.rogerthat_api.to import UserDetailsTO
 from plugins.rogerthat_api.to.messaging.flow import MessageFlowStepTO, FormFlowStepTO, FLOW_STEP_MAPPING
 from plugins.rogerthat_api.to.messaging.service_callback_results import FlowMemberResultCallbackResultTO, \
     FlowCallbackResultTypeTO, FormCallbackResultTypeTO, MessageCallbackResultTypeTO
 from plugins.tff_backend.bizz.email import send_emails_to_support
+from plugins.tff_backend.bizz.gcs import open_gcs_file, concatenate_gcs_files, delete_gcs_files
 from plugins.tff_backend.bizz.iyo.utils import get_username
 from plugins.tff_backend.bizz.user import get_tff_profile
 from plugins.tff_backend.firebase import put_firebase_data
-from plugins.tff_backend.models.statistics import FlowRun, FlowRunStatus, FlowRunStatistics, StepStatistics
+from plugins.tff_backend.models.statistics import FlowRun, FlowRunStatus, FlowRunStatistics, StepStatistics, \
+    LatestFlowRun, FlowName, FlowRunSummary
+from plugins.tff_backend.plugin_consts import FLOW_STATISTICS_QUEUE
 from plugins.tff_backend.to.dashboard import TickerEntryTO, TickerEntryType
 from plugins.tff_backend.utils import get_key_name_from_key_string
 
 
 @ndb.non_transactional()
 def _create_flow_run(flow_run_key, tag, message_flow_name, user_details, timestamp):
+    _register_flow_name(message_flow_name)
     return FlowRun(key=flow_run_key,
                    tag=tag,
                    flow_name=message_flow_name,
@@ -50,19 +61,142 @@ def _create_flow_run(flow_run_key, tag, message_flow_name, user_details, timesta
                    status=FlowRunStatus.STARTED)
 
 
-@ndb.transactional(xg=True)
+# Callbacks for the same flow run that arrive within this many seconds are merged by a single worker task
+FLOW_STATISTICS_BATCH_INTERVAL = 5
+FLOW_STATISTICS_LEASE_SECONDS = 60
+FLOW_STATISTICS_MAX_TASKS = 100
+# Number of times a callback may be leased before it is applied on its own and dropped when that fails too
+FLOW_STATISTICS_MAX_RETRIES = 5
+FLOW_STATISTICS_EXPORT_PAGE_SIZE = 200
+FLOW_STATISTICS_EXPORT_FILES = ('flow_runs', 'flow_run_steps')
+FLOW_RUN_EXPORT_COLUMNS = ['id', 'flow_name', 'tag', 'user', 'status', 'start_date', 'last_step_date', 'total_time',
+                           'next_step', 'step_count']
+FLOW_RUN_STEP_EXPORT_COLUMNS = ['flow_run_id', 'index', 'step_id', 'step_type', 'answer_id', 'received_timestamp',
+                                'acknowledged_timestamp', 'time_taken']
+# Time after the last step after which an in progress flow is considered stalled
+FLOW_STALL_TIMEOUT = relativedelta.relativedelta(minutes=15)
+
+
+def queue_flow_statistics(parent_message_key, steps, end_id, tag, flush_id, flush_message_flow_id, user_details,
+                          timestamp, next_step):
+    """
+    Adds the callback to a pull queue, tagged by flow run, and schedules one worker per flow run per batch interval.
+    This avoids multiple tasks updating the same FlowRun concurrently.
+    """
+    payload = pickle.dumps((steps, end_id, tag, flush_id, flush_message_flow_id, user_details, timestamp, next_step),
+                           pickle.HIGHEST_PROTOCOL)
+    task_tag = _get_flow_statistics_task_tag(parent_message_key)
+    taskqueue.Queue(FLOW_STATISTICS_QUEUE).add(taskqueue.Task(payload=payload, method='PULL', tag=task_tag))
+    # The worker only runs after the current interval has passed, so it will lease every callback added in the meantime
+    now_ = time.time()
+    bucket = int(now_ / FLOW_STATISTICS_BATCH_INTERVAL)
+    countdown = (bucket + 1) * FLOW_STATISTICS_BATCH_INTERVAL - now_ + 1
+    task_name = 'flow-statistics-%s-%d' % (hashlib.sha1(task_tag).hexdigest(), bucket)
+    try:
+        deferred.defer(process_flow_statistics, parent_message_key, _name=task_name, _countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.debug('Flow statistics worker %s has already been scheduled', task_name)
+
+
+def _get_flow_statistics_task_tag(parent_message_key):
+    return parent_message_key.encode('utf-8') if isinstance(parent_message_key, unicode) else parent_message_key
+
+
+def process_flow_statistics(parent_message_key):
+    queue = taskqueue.Queue(FLOW_STATISTICS_QUEUE)
+    task_tag = _get_flow_statistics_task_tag(parent_message_key)
+    while True:
+        tasks = queue.lease_tasks_by_tag(FLOW_STATISTICS_LEASE_SECONDS, FLOW_STATISTICS_MAX_TASKS, tag=task_tag)
+        if not tasks:
+            return
+        _process_flow_statistics_tasks(queue, parent_message_key, tasks)
+        if len(tasks) < FLOW_STATISTICS_MAX_TASKS:
+            return
+
+
+def _process_flow_statistics_tasks(queue, parent_message_key, tasks):
+    # type: (taskqueue.Queue, unicode, list[taskqueue.Task]) -> None
+    callbacks = []
+    for task in tasks:
+        try:
+            callbacks.append((pickle.loads(task.payload), task))
+        except Exception:
+            logging.exception('Dropping flow statistics callback %s of flow run %s which could not be unpickled',
+                              task.name, parent_message_key)
+            queue.delete_tasks(task)
+    # Callbacks that keep failing are applied one by one, so only the faulty ones are dropped
+    failing = [(callback, task) for callback, task in callbacks if task.retry_count > FLOW_STATISTICS_MAX_RETRIES]
+    for callback, task in failing:
+        try:
+            _save_flow_statistics(parent_message_key, [callback])
+        except Exception:
+            logging.exception('Dropping flow statistics callback %s of flow run %s after %d attempts', task.name,
+                              parent_message_key, task.retry_count)
+        queue.delete_tasks(task)
+    failing_tasks = {task.name for _, task in failing}
+    callbacks = sorted((c for c in callbacks if c[1].name not in failing_tasks), key=lambda c: (c[0][6], len(c[0][0])))
+    if not callbacks:
+        return
+    logging.debug('Merging %d flow statistics callbacks for flow run %s', len(callbacks), parent_message_key)
+    try:
+        _save_flow_statistics(parent_message_key, [callback for callback, _ in callbacks])
+    except Exception:
+        # Release the leases so the retry of this task can lease these callbacks again right away
+        for _, task in callbacks:
+            queue.modify_task_lease(task, 0)
+        raise
+    queue.delete_tasks([task for _, task in callbacks])
+
+
 @arguments(parent_message_key=unicode, steps=[(MessageFlowStepTO, FormFlowStepTO)], end_id=unicode, tag=unicode,
            flush_id=unicode, flush_message_flow_id=unicode, user_details=UserDetailsTO, timestamp=(int, long),
            next_step=FlowMemberResultCallbackResultTO)
 def save_flow_statistics(parent_message_key, steps, end_id, tag, flush_id, flush_message_flow_id, user_details,
                          timestamp, next_step):
-    message_flow_name = get_key_name_from_key_string(flush_message_flow_id)
+    _save_flow_statistics(parent_message_key,
+                          [(steps, end_id, tag, flush_id, flush_message_flow_id, user_details, timestamp, next_step)])
+
+
+@ndb.transactional(xg=True)
+def _save_flow_statistics(parent_message_key, callbacks):
     flow_run_key = FlowRun.create_key(parent_message_key)
     flow_run = flow_run_key.get()  # type: FlowRun
+    is_new = flow_run is None
+    updated = False
+    for steps, end_id, tag, flush_id, flush_message_flow_id, user_details, timestamp, next_step in callbacks:
+        updated_flow_run = _apply_flow_statistics(flow_run_key, flow_run, steps, end_id, tag, flush_id,
+                                                  flush_message_flow_id, user_details, timestamp, next_step)
+        if updated_flow_run:
+            flow_run = updated_flow_run
+            updated = True
+    if updated:
+        to_put = [flow_run, FlowRunSummary.from_flow_run(flow_run)]
+        if is_new:
+            latest_run = _get_updated_latest_flow_run(flow_run)
+            if latest_run:
+                to_put.append(latest_run)
+        ndb.put_multi(to_put)
+        try_or_defer(save_flow_run_status_to_firebase, flow_run.key)
+
+
+def _get_updated_latest_flow_run(flow_run):
+    # type: (FlowRun) -> LatestFlowRun
+    key = LatestFlowRun.create_key(flow_run.flow_name, flow_run.user)
+    latest_run = key.get() or LatestFlowRun(key=key)  # type: LatestFlowRun
+    if latest_run.start_date and latest_run.start_date > flow_run.start_date:
+        return None
+    latest_run.populate(flow_run_key=flow_run.key, start_date=flow_run.start_date)
+    return latest_run
+
+
+def _apply_flow_statistics(flow_run_key, flow_run, steps, end_id, tag, flush_id, flush_message_flow_id, user_details,
+                           timestamp, next_step):
+    # type: (ndb.Key, FlowRun, list, unicode, unicode, unicode, unicode, UserDetailsTO, long, object) -> FlowRun
+    message_flow_name = get_key_name_from_key_string(flush_message_flow_id)
     if not flow_run:
         if not message_flow_name:
             logging.warn('Ignoring callback since we could not determine the message flow name')
-            return
+            return None
         flow_run_status = FlowRunStatus.STARTED
         flow_run = _create_flow_run(flow_run_key, tag, message_flow_name, user_details, timestamp)
     else:
@@ -70,7 +204,7 @@ def save_flow_statistics(parent_message_key, steps, end_id, tag, flush_id, flush
         steps = merge_steps(flow_run, steps)
         if len(flow_run.steps) > len(steps):
             logging.info('Ignoring callback since all steps have already been saved')
-            return
+            return None
         # Once canceled or finished, always canceled or finished. Rest can still be changed.
         if flow_run.status not in (FlowRunStatus.CANCELED, FlowRunStatus.FINISHED):
             if 'cancel' in flush_id:
@@ -91,8 +225,7 @@ def save_flow_statistics(parent_message_key, steps, end_id, tag, flush_id, flush
             raise Exception('Unknown callback result %s', next_step)
     calculate_flow_run_statistics(flow_run, timestamp, steps, flow_run_status, flush_id, next_step_id)
     flow_run.populate(status=flow_run_status, steps=[s.to_dict() for s in steps])
-    flow_run.put()
-    try_or_defer(save_flow_run_status_to_firebase, flow_run.key)
+    return flow_run
 
 
 def save_flow_run_status_to_firebase(flow_run_key):
@@ -151,10 +284,15 @@ def calculate_flow_run_statistics(flow_run, timestamp, steps, flow_run_status, f
         total_time=total_time,
         steps=steps_statistics
     )
+    if flow_run_status == FlowRunStatus.IN_PROGRESS:
+        flow_run.stall_deadline = last_step_date + FLOW_STALL_TIMEOUT
+    else:
+        flow_run.stall_deadline = None
     return flow_run
 
 
 def list_flow_runs(cursor, page_size, flow_name, start_date):
+    # type: (unicode, int, unicode, unicode) -> tuple[list[FlowRunSummary], ndb.Cursor, bool]
     start_date = start_date and dateutil.parser.parse(start_date.replace('Z', ''))
     if start_date:
         qry = FlowRun.list_by_start_date(start_date)
@@ -162,11 +300,27 @@ def list_flow_runs(cursor, page_size, flow_name, start_date):
         qry = FlowRun.list_by_flow_name(flow_name)
     else:
         qry = FlowRun.list()
-    return qry.fetch_page(page_size, start_cursor=ndb.Cursor(urlsafe=cursor))
+    keys, cursor, more = qry.fetch_page(page_size, start_cursor=ndb.Cursor(urlsafe=cursor), keys_only=True)
+    return _get_flow_run_summaries(keys), cursor, more
 
 
 def list_flow_runs_by_user(username, cursor, page_size):
-    return FlowRun.list_by_user(username).fetch_page(page_size, start_cursor=ndb.Cursor(urlsafe=cursor))
+    # type: (unicode, unicode, int) -> tuple[list[FlowRunSummary], ndb.Cursor, bool]
+    keys, cursor, more = FlowRun.list_by_user(username).fetch_page(page_size, start_cursor=ndb.Cursor(urlsafe=cursor),
+                                                                   keys_only=True)
+    return _get_flow_run_summaries(keys), cursor, more
+
+
+def _get_flow_run_summaries(flow_run_keys):
+    # type: (list[ndb.Key]) -> list[FlowRunSummary]
+    summaries = ndb.get_multi([FlowRunSummary.create_key(key.id()) for key in flow_run_keys])
+    missing_keys = [key for key, summary in zip(flow_run_keys, summaries) if not summary]
+    if missing_keys:
+        # Flow runs which haven't been updated since summaries were introduced and haven't been migrated yet
+        missing = {flow_run.id: FlowRunSummary.from_flow_run(flow_run)
+                   for flow_run in ndb.get_multi(missing_keys) if flow_run}
+        summaries = [summary or missing.get(key.id()) for key, summary in zip(flow_run_keys, summaries)]
+    return [summary for summary in summaries if summary]
 
 
 def get_flow_run(flow_run_id):
@@ -177,13 +331,21 @@ def get_flow_run(flow_run_id):
     return flow_run
 
 
+@cached(version=1, lifetime=86400, request=True, memcache=True)
+@returns([unicode])
+@arguments()
 def list_distinct_flows():
-    return FlowRun.list_distinct_flows()
+    return [key.id() for key in FlowName.list().fetch(keys_only=True)]
+
+
+def _register_flow_name(flow_name):
+    if flow_name not in list_distinct_flows():
+        FlowName(key=FlowName.create_key(flow_name)).put()
+        invalidate_cache(list_distinct_flows)
 
 
 def check_stuck_flows():
-    fifteen_minutes_ago = datetime.now() - relativedelta.relativedelta(minutes=15)
-    run_job(_get_stalled_flows, [fifteen_minutes_ago], _set_flow_run_as_stalled, [])
+    run_job(_get_stalled_flows, [datetime.now()], _set_flow_run_as_stalled, [])
 
 
 def should_notify_for_flow(flow_run):
@@ -192,7 +354,11 @@ def should_notify_for_flow(flow_run):
         logging.info('Not notifying of stalled flow %s because status != stalled', flow_run.id)
         return False
     # Ensure no unnecessary messages are sent in case user started this same flow again in the meantime
-    newest_key = FlowRun.list_by_user_and_flow(flow_run.flow_name, flow_run.user).fetch(1, keys_only=True)[0]
+    latest_run = LatestFlowRun.create_key(flow_run.flow_name, flow_run.user).get()  # type: LatestFlowRun
+    if latest_run:
+        newest_key = latest_run.flow_run_key
+    else:
+        newest_key = FlowRun.list_by_user_and_flow(flow_run.flow_name, flow_run.user).fetch(1, keys_only=True)[0]
     if flow_run.id != newest_key.id():
         logging.info('Not notifying of stalled flow, user has restarted this flow. Newer flow key: %s', newest_key.id())
         return False
@@ -214,17 +380,106 @@ def notify_stalled_flow_run(flow_run_key):
     send_emails_to_support(subject, body)
 
 
-def _get_stalled_flows(fifteen_minutes_ago):
-    return FlowRun.list_by_status_and_last_step_date(FlowRunStatus.IN_PROGRESS, fifteen_minutes_ago)
+def _get_stalled_flows(date):
+    return FlowRun.list_by_stall_deadline(date)
 
 
-@ndb.transactional()
+@ndb.transactional(xg=True)
 def _set_flow_run_as_stalled(flow_run_key):
     flow_run = flow_run_key.get()  # type: FlowRun
-    if flow_run.status != FlowRunStatus.IN_PROGRESS:
+    is_stalled = flow_run.stall_deadline and flow_run.stall_deadline < datetime.now()
+    if flow_run.status != FlowRunStatus.IN_PROGRESS or not is_stalled:
         logging.debug('Ignoring updated flow run %s', flow_run)
         return
     flow_run.status = FlowRunStatus.STALLED
-    flow_run.put()
+    flow_run.stall_deadline = None
+    ndb.put_multi([flow_run, FlowRunSummary.from_flow_run(flow_run)])
     deferred.defer(notify_stalled_flow_run, flow_run_key, _transactional=True)
     deferred.defer(save_flow_run_status_to_firebase, flow_run_key, _transactional=True)
+
+
+def export_flow_statistics(date=None):
+    # type: (datetime) -> None
+    """
+    Exports the flow runs started on the given day (yesterday by default) to gzipped csv files on GCS.
+    Every page of flow runs is exported to temporary files by a separate task, the last task concatenates them.
+    """
+    if not date:
+        date = datetime.now() - relativedelta.relativedelta(days=1)
+    deferred.defer(_export_flow_statistics_page, date.date(), int(time.time()), 0, None, 0)
+
+
+def _get_flow_statistics_export_part(day, export_id, name, part):
+    return 'flow-statistics-tmp/date=%s/%d/%s-%05d.csv.gz' % (day.isoformat(), export_id, name, part)
+
+
+def _export_flow_statistics_page(day, export_id, part, cursor, count):
+    start_date = datetime(day.year, day.month, day.day)
+    end_date = start_date + relativedelta.relativedelta(days=1)
+    qry = FlowRun.list_by_start_date_range(start_date, end_date)
+    flow_runs, next_cursor, more = qry.fetch_page(FLOW_STATISTICS_EXPORT_PAGE_SIZE,
+                                                  start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+    runs_rows = [FLOW_RUN_EXPORT_COLUMNS] if part == 0 else []
+    steps_rows = [FLOW_RUN_STEP_EXPORT_COLUMNS] if part == 0 else []
+    for flow_run in flow_runs:  # type: FlowRun
+        runs_rows.append(_get_flow_run_export_row(flow_run))
+        steps_rows.extend(_get_flow_run_step_export_rows(flow_run))
+    for name, rows in zip(FLOW_STATISTICS_EXPORT_FILES, (runs_rows, steps_rows)):
+        with open_gcs_file(_get_flow_statistics_export_part(day, export_id, name, part), 'application/gzip') as f:
+            gzip_file = gzip.GzipFile(fileobj=f, mode='wb')
+            csv.writer(gzip_file).writerows(rows)
+            gzip_file.close()
+    count += len(flow_runs)
+    if more and next_cursor:
+        args = (_export_flow_statistics_page, day, export_id, part + 1, next_cursor.urlsafe(), count)
+    else:
+        args = (_finish_flow_statistics_export, day, export_id, part + 1, count)
+    # Named, so a retry of this task doesn't export the next page twice
+    task_name = 'export-flow-statistics-%s-%d-%d' % (day.isoformat(), export_id, part + 1)
+    try:
+        deferred.defer(*args, _name=task_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.debug('Next flow statistics export task %s has already been scheduled', task_name)
+
+
+def _finish_flow_statistics_export(day, export_id, part_count, count):
+    folder = 'flow-statistics/date=%s' % day.isoformat()
+    parts = []
+    for name in FLOW_STATISTICS_EXPORT_FILES:
+        name_parts = [_get_flow_statistics_export_part(day, export_id, name, part) for part in xrange(part_count)]
+        # A file with multiple gzip members is a valid gzip file
+        concatenate_gcs_files(name_parts, '%s/%s.csv.gz' % (folder, name), 'application/gzip')
+        parts.extend(name_parts)
+    delete_gcs_files(parts)
+    logging.info('Exported %d flow runs to %s', count, folder)
+
+
+def _get_flow_run_export_row(flow_run):
+    # type: (FlowRun) -> list[str]
+    statistics = flow_run.statistics or FlowRunStatistics()
+    row = [flow_run.id, flow_run.flow_name, flow_run.tag, flow_run.user, flow_run.status, flow_run.start_date,
+           statistics.last_step_date, statistics.total_time, statistics.next_step, len(flow_run.steps)]
+    return [_to_csv_value(value) for value in row]
+
+
+def _get_flow_run_step_export_rows(flow_run):
+    # type: (FlowRun) -> list[list[str]]
+    # Form results are not exported since they can contain sensitive data
+    step_statistics = flow_run.statistics.steps if flow_run.statistics else []
+    rows = []
+    for i, step in enumerate(flow_run.steps):
+        time_taken = step_statistics[i].time_taken if i < len(step_statistics) else None
+        row = [flow_run.id, i, step.get('step_id'), step.get('step_type'), step.get('answer_id'),
+               step.get('received_timestamp'), step.get('acknowledged_timestamp'), time_taken]
+        rows.append([_to_csv_value(value) for value in row])
+    return rows
+
+
+def _to_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
@@ -14,6 +14,7 @@
 # limitations under the License.
 #
 # @@license_version:1.3@@
+import base64
 import hashlib
 import hmac
 
@@ -24,8 +25,13 @@ from cloudstorage.common import local_api_url
 from framework.plugin_loader import get_config
 from mcfw.consts import DEBUG
 from plugins.tff_backend.plugin_consts import NAMESPACE
+from plugins.tff_backend.utils import LRUCache
 
 _default_bucket = None
+_serving_url_prefixes = {}
+# Only the names of recently used documents need to be cached
+_encrypted_filenames = LRUCache(10000)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # multiple of the 256KB cloudstorage write buffer
 
 
 def _get_default_bucket():
@@ -36,26 +42,118 @@ def _get_default_bucket():
     return _default_bucket
 
 
-def upload_to_gcs(filename, file_data, content_type, bucket=None):
+def upload_to_gcs(filename, file_data, content_type, bucket=None, options=None):
+    """
+    Args:
+        file_data (str or file): the file contents, or a file-like object which is uploaded in chunks
+    """
     if isinstance(filename, unicode):
         filename = filename.encode('utf-8')
     if not bucket:
         bucket = _get_default_bucket()
-    file_path = '/%s/%s' % (bucket, filename)
-    with cloudstorage.open(file_path, 'w', content_type=content_type) as f:
-        f.write(file_data)
+    with open_gcs_file(filename, content_type, bucket, options) as f:
+        if hasattr(file_data, 'read'):
+            while True:
+                chunk = file_data.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+        else:
+            f.write(file_data)
+    return get_serving_url(filename, bucket)
+
+
+def upload_base64_to_gcs(filename, base64_data, content_type, bucket=None, options=None):
+    """Decodes and uploads base64 data in chunks, so the decoded file never has to be kept in memory entirely"""
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    if not bucket:
+        bucket = _get_default_bucket()
+    # Chunks must be a multiple of 4 base64 characters (which are decoded to 3 bytes), so remove any line breaks
+    base64_data = ''.join(base64_data.split())
+    chunk_size = UPLOAD_CHUNK_SIZE / 3 * 4
+    with open_gcs_file(filename, content_type, bucket, options) as f:
+        for i in xrange(0, len(base64_data), chunk_size):
+            f.write(base64.b64decode(base64_data[i:i + chunk_size]))
     return get_serving_url(filename, bucket)
 
 
+def open_gcs_file(filename, content_type, bucket=None, options=None):
+    """Opens a file for writing, allowing it to be written in multiple parts."""
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    if not bucket:
+        bucket = _get_default_bucket()
+    file_path = '/%s/%s' % (bucket, filename)
+    return cloudstorage.open(file_path, 'w', content_type=content_type, options=options)
+
+
+def concatenate_gcs_files(filenames, destination, content_type, bucket=None):
+    """
+    Writes the contents of the files one after another to `destination`.
+    The destination file is only created once every file has been copied completely.
+    """
+    if not bucket:
+        bucket = _get_default_bucket()
+    destination_file = open_gcs_file(destination, content_type, bucket)
+    for filename in filenames:
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        with cloudstorage.open('/%s/%s' % (bucket, filename), 'r') as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                destination_file.write(chunk)
+    # Not closed when an exception occurs, so no incomplete file is created
+    destination_file.close()
+
+
+def delete_gcs_files(filenames, bucket=None):
+    if not bucket:
+        bucket = _get_default_bucket()
+    for filename in filenames:
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        try:
+            cloudstorage.delete('/%s/%s' % (bucket, filename))
+        except cloudstorage.NotFoundError:
+            pass
+
+
+def get_gcs_file_info(filename, bucket=None):
+    # type: (unicode, str) -> cloudstorage.GCSFileStat
+    """Returns the info (size, metadata...) of a file or None when it doesn't exist"""
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    if not bucket:
+        bucket = _get_default_bucket()
+    try:
+        return cloudstorage.stat('/%s/%s' % (bucket, filename))
+    except cloudstorage.NotFoundError:
+        return None
+
+
 def get_serving_url(filename, bucket=None):
     # type: (unicode) -> unicode
     if not bucket:
         bucket = _get_default_bucket()
-    if DEBUG:
-        return '%s/%s/%s' % (local_api_url(), bucket, filename)
-    return 'https://storage.googleapis.com/%s/%s' % (bucket, filename)
+    prefix = _serving_url_prefixes.get(bucket)
+    if not prefix:
+        if DEBUG:
+            prefix = '%s/%s/' % (local_api_url(), bucket)
+        else:
+            prefix = 'https://storage.googleapis.com/%s/' % bucket
+        _serving_url_prefixes[bucket] = prefix
+    return prefix + filename
 
 
 def encrypt_filename(filename):
-    encryption_key = get_config(NAMESPACE).cloudstorage_encryption_key
-    return hmac.new(encryption_key.encode(), unicode(filename), hashlib.sha1).hexdigest()
+    # Called for every document url in list results, so avoid calculating the same hmac over and over again
+    filename = unicode(filename)
+    encrypted_filename = _encrypted_filenames.get(filename)
+    if not encrypted_filename:
+        encryption_key = get_config(NAMESPACE).cloudstorage_encryption_key
+        encrypted_filename = hmac.new(encryption_key.encode(), filename, hashlib.sha1).hexdigest()
+        _encrypted_filenames.set(filename, encrypted_filename)
+    return encrypted_filename
@@ -16,25 +16,54 @@
 # @@license_version:1.3@@
 import json
 import logging
+import time
+import uuid
 
-from google.appengine.api import urlfetch
-from google.appengine.ext import ndb
+from google.appengine.api import urlfetch, taskqueue, memcache
+from google.appengine.ext import ndb, deferred
 
+from framework.consts import DAY
 from framework.plugin_loader import get_config
 from framework.utils import now
-from mcfw.cache import cached
 from mcfw.exceptions import HttpNotFoundException, HttpBadRequestException
-from mcfw.rpc import arguments, returns
 from plugins.rogerthat_api.exceptions import BusinessException
-from plugins.tff_backend.models.global_stats import GlobalStats, CurrencyValue
+from plugins.tff_backend.models.global_stats import GlobalStats, CurrencyValue, CurrencyRates
 from plugins.tff_backend.plugin_consts import NAMESPACE
 from plugins.tff_backend.to.global_stats import GlobalStatsTO
 
 
+FIAT_RATES = u'fiat'
+CRYPTO_RATES = u'crypto'
+# Seconds after which rates are refreshed in the background. Max 1000 calls / month with free exchangerate account.
+CURRENCY_RATES_TTL = {
+    FIAT_RATES: 3600,
+    CRYPTO_RATES: 300,
+}
+# Rates older than this are refreshed before they are used
+CURRENCY_RATES_MAX_AGE = DAY
+# Changed whenever GlobalStats are saved, so every instance knows when to drop its cached GlobalStats
+GLOBAL_STATS_VERSION_KEY = 'global_stats_version'
+# Seconds after which the version of cached GlobalStats is compared with the version in memcache again
+GLOBAL_STATS_VERSION_CHECK_INTERVAL = 10
+# Seconds after which cached GlobalStats are always reloaded, in case setting a new version in memcache failed
+GLOBAL_STATS_CACHE_TTL = 300
+_global_stats_cache = {}  # type: dict[unicode, CachedGlobalStats]
+
+
 class ApiCallException(Exception):
     pass
 
 
+class CachedGlobalStats(object):
+    def __init__(self, version, stats, timestamp):
+        # type: (str, GlobalStats, float) -> None
+        self.version = version
+        self.stats = stats
+        self.cached_at = timestamp
+        self.checked_at = timestamp
+        self.currency_values = {currency.currency: currency.value for currency in stats.currencies}
+
+
 def list_global_stats():
     # type: () -> list[GlobalStats]
     return GlobalStats.list()
@@ -45,6 +74,59 @@ def get_global_stats(stats_id):
     return GlobalStats.create_key(stats_id).get()
 
 
+def get_cached_global_stats(stats_id):
+    # type: (unicode) -> GlobalStats
+    """
+    GlobalStats cached on this instance until they are saved again, or None if they don't exist.
+    The returned model must not be modified.
+    """
+    cached_stats = _get_cached_global_stats(stats_id)
+    return cached_stats and cached_stats.stats
+
+
+def get_cached_currency_value(stats_id, currency):
+    # type: (unicode, unicode) -> float
+    """Value of 1 token in the given currency, or None if no value has been set for that currency"""
+    cached_stats = _get_cached_global_stats(stats_id)
+    return cached_stats and cached_stats.currency_values.get(currency)
+
+
+def _get_cached_global_stats(stats_id):
+    # type: (unicode) -> CachedGlobalStats
+    timestamp = time.time()
+    cached_stats = _global_stats_cache.get(stats_id)
+    if cached_stats:
+        if timestamp - cached_stats.cached_at > GLOBAL_STATS_CACHE_TTL:
+            cached_stats = None
+        elif timestamp - cached_stats.checked_at > GLOBAL_STATS_VERSION_CHECK_INTERVAL:
+            if cached_stats.version is None or cached_stats.version != _get_global_stats_version():
+                cached_stats = None
+            else:
+                cached_stats.checked_at = timestamp
+    if not cached_stats:
+        version = _get_global_stats_version()
+        stats = get_global_stats(stats_id)
+        if not stats:
+            return None
+        cached_stats = CachedGlobalStats(version, stats, timestamp)
+        _global_stats_cache[stats_id] = cached_stats
+    return cached_stats
+
+
+def _get_global_stats_version():
+    version = memcache.get(GLOBAL_STATS_VERSION_KEY, namespace=NAMESPACE)
+    if version is None:
+        # Evicted from memcache, so any cached version could be outdated
+        memcache.add(GLOBAL_STATS_VERSION_KEY, uuid.uuid4().hex, namespace=NAMESPACE)
+        version = memcache.get(GLOBAL_STATS_VERSION_KEY, namespace=NAMESPACE)
+    return version
+
+
+def invalidate_global_stats_cache():
+    _global_stats_cache.clear()
+    memcache.set(GLOBAL_STATS_VERSION_KEY, uuid.uuid4().hex, namespace=NAMESPACE)
+
+
 def put_global_stats(stats_id, stats):
     # type: (unicode, GlobalStatsTO) -> GlobalStats
     assert isinstance(stats, GlobalStatsTO)
@@ -87,38 +169,80 @@ def _get_current_currency_rates():
     """
     Keys are currencies, values are the price of 1 USD in that currency
     """
-    result = get_fiat_rate()
-    result.update(get_crypto_rate())
+    rates = _get_currency_rates([FIAT_RATES, CRYPTO_RATES])
+    result = rates[FIAT_RATES]
+    result.update(rates[CRYPTO_RATES])
     return result
 
 
-def get_fiat_rate():
-    # type: () -> dict[unicode, float]
-    return {k: 1.0 / v for k, v in json.loads(_get_fiat_rate())['rates'].iteritems()}
-
-
-def get_crypto_rate():
-    # type: () -> dict[unicode, float]
-    return {r['symbol']: float(r['price_usd']) for r in json.loads(_get_crypto_rate())}
-
-
-@cached(1)
-@returns(unicode)
-@arguments()
-def _get_fiat_rate():
-    # Max 1000 calls / month with free account
-    return _fetch('https://v3.exchangerate-api.com/bulk/%s/USD' % get_config(NAMESPACE).exchangerate_key)
-
-
-@cached(1)
-@returns(unicode)
-@arguments()
-def _get_crypto_rate():
-    return _fetch('https://api.coinmarketcap.com/v1/ticker')
-
-
-def _fetch(url):
-    result = urlfetch.fetch(url)  # type: urlfetch._URLFetchResult
+def _get_currency_rates(sources):
+    # type: (list[unicode]) -> dict[unicode, dict[unicode, float]]
+    """
+    Returns the stored rates of each source. Outdated rates are still returned while they are refreshed in the
+    background, only missing or very old rates are fetched before returning.
+    """
+    now_ = now()
+    models = dict(zip(sources, ndb.get_multi([CurrencyRates.create_key(source) for source in sources])))
+    to_fetch = []
+    for source, model in models.iteritems():  # type: unicode, CurrencyRates
+        age = model and now_ - model.timestamp
+        if not model or age > CURRENCY_RATES_MAX_AGE:
+            to_fetch.append(source)
+        elif age > CURRENCY_RATES_TTL[source]:
+            _schedule_currency_rates_refresh(source, now_)
+    if to_fetch:
+        models.update({model.source: model for model in refresh_currency_rates(to_fetch)})
+    return {source: model.rates for source, model in models.iteritems()}
+
+
+def _schedule_currency_rates_refresh(source, timestamp):
+    # Named task to ensure the rates are only fetched once per ttl
+    task_name = 'refresh-currency-rates-%s-%d' % (source, timestamp / CURRENCY_RATES_TTL[source])
+    try:
+        deferred.defer(refresh_currency_rates, [source], _name=task_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.debug('Refresh of %s rates has already been scheduled', source)
+
+
+def refresh_currency_rates(sources):
+    # type: (list[unicode]) -> list[CurrencyRates]
+    # Fetch all sources in parallel
+    urls = [_get_currency_rates_url(source) for source in sources]
+    rpcs = [_fetch_async(url) for url in urls]
+    timestamp = now()
+    models = [CurrencyRates(key=CurrencyRates.create_key(source),
+                            rates=_parse_currency_rates(source, _get_fetch_result(url, rpc)),
+                            timestamp=timestamp)
+              for source, url, rpc in zip(sources, urls, rpcs)]
+    ndb.put_multi(models)
+    return models
+
+
+def _get_currency_rates_url(source):
+    if source == FIAT_RATES:
+        return 'https://v3.exchangerate-api.com/bulk/%s/USD' % get_config(NAMESPACE).exchangerate_key
+    elif source == CRYPTO_RATES:
+        return 'https://api.coinmarketcap.com/v1/ticker'
+    raise BusinessException('Unknown currency rates source %s' % source)
+
+
+def _parse_currency_rates(source, content):
+    # type: (unicode, str) -> dict[unicode, float]
+    if source == FIAT_RATES:
+        return {k: 1.0 / v for k, v in json.loads(content)['rates'].iteritems()}
+    elif source == CRYPTO_RATES:
+        return {r['symbol']: float(r['price_usd']) for r in json.loads(content)}
+    raise BusinessException('Unknown currency rates source %s' % source)
+
+
+def _fetch_async(url):
+    rpc = urlfetch.create_rpc()
+    urlfetch.make_fetch_call(rpc, url)
+    return rpc
+
+
+def _get_fetch_result(url, rpc):
+    result = rpc.get_result()  # type: urlfetch._URLFetchResult
     logging.info('Response from %s: %s %s', url, result.status_code, result.content)
     if result.status_code != 200:
         raise BusinessException('Invalid status from %s: %s' % (url, result.status_code))
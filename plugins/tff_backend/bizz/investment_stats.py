@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.4@@
+import logging
+from collections import defaultdict
+from datetime import datetime, date, timedelta
+
+from google.appengine.ext import ndb
+
+from framework.bizz.job import run_job, MODE_BATCH
+from framework.consts import DAY
+from framework.utils import now
+from mcfw.exceptions import HttpBadRequestException
+from plugins.tff_backend.models.investor import InvestmentAgreement, InvestmentAgreementDailyStats
+
+# Agreements modified within this period are (re)counted by the daily job
+AGGREGATION_PERIOD = 2 * DAY
+
+
+def aggregate_investment_agreements(since=None):
+    """
+    Updates the daily investment agreement statistics with every agreement that was modified since `since`.
+    Use since=0 to rebuild the statistics of all agreements.
+    """
+    if since is None:
+        since = now() - AGGREGATION_PERIOD
+    run_job(_get_modified_agreements, [since], _aggregate_agreements, [], mode=MODE_BATCH, batch_size=200)
+
+
+def _get_modified_agreements(since):
+    return InvestmentAgreement.list_modified_since(since)
+
+
+def _aggregate_agreements(agreement_keys):
+    agreements_per_day = defaultdict(list)
+    for agreement in ndb.get_multi(agreement_keys):  # type: InvestmentAgreement
+        if not agreement or not agreement.creation_time:
+            continue
+        day = datetime.utcfromtimestamp(agreement.creation_time).date()
+        agreements_per_day[day].append((agreement.id, agreement.token, agreement.currency, agreement.status,
+                                        agreement.amount or 0.0, agreement.token_count_float or 0.0))
+    for day, agreements in agreements_per_day.iteritems():
+        _update_daily_stats(day, agreements)
+
+
+@ndb.transactional()
+def _update_daily_stats(day, agreements):
+    # type: (date, list[tuple]) -> InvestmentAgreementDailyStats
+    key = InvestmentAgreementDailyStats.create_key(day)
+    stats = key.get() or InvestmentAgreementDailyStats(key=key, date=day)
+    for agreement in agreements:
+        stats.set_agreement(*agreement)
+    stats.update_totals()
+    stats.put()
+    logging.debug('Updated investment agreement statistics of %s with %d agreements', day, len(agreements))
+    return stats
+
+
+def list_investment_agreement_stats(start_date=None, end_date=None):
+    # type: (unicode, unicode) -> list[InvestmentAgreementDailyStats]
+    end = _parse_date(end_date) if end_date else datetime.utcnow().date()
+    start = _parse_date(start_date) if start_date else end - timedelta(days=30)
+    if start > end:
+        raise HttpBadRequestException('invalid_date_range')
+    return InvestmentAgreementDailyStats.list_by_date(start, end).fetch()
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise HttpBadRequestException('invalid_date', {'date': value})
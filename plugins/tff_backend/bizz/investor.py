@@ -25,8 +25,9 @@ from google.appengine.api import users
 from google.appengine.ext import deferred, ndb
 
 from babel.numbers import get_currency_name
+from framework.bizz.job import run_job, MODE_BATCH
 from framework.consts import get_base_url, DAY
-from framework.utils import now, azzert, try_or_defer
+from framework.utils import now, azzert
 from mcfw.exceptions import HttpNotFoundException, HttpBadRequestException
 from mcfw.properties import object_factory
 from mcfw.rpc import returns, arguments
@@ -40,10 +41,11 @@ from plugins.rogerthat_api.to.messaging.service_callback_results import FlowMemb
     FlowCallbackResultTypeTO, TYPE_FLOW
 from plugins.tff_backend.bizz import get_tf_token_api_key, intercom_helpers, get_mazraa_api_key
 from plugins.tff_backend.bizz.agreements import get_bank_account_info
+from plugins.tff_backend.bizz.agreements.render import schedule_pdf_render, PdfType
 from plugins.tff_backend.bizz.authentication import RogerthatRoles
 from plugins.tff_backend.bizz.email import send_emails_to_support
-from plugins.tff_backend.bizz.gcs import upload_to_gcs
-from plugins.tff_backend.bizz.global_stats import get_global_stats
+from plugins.tff_backend.bizz.gcs import upload_base64_to_gcs
+from plugins.tff_backend.bizz.global_stats import get_cached_global_stats, get_cached_currency_value
 from plugins.tff_backend.bizz.intercom_helpers import IntercomTags
 from plugins.tff_backend.bizz.iyo.utils import get_username
 from plugins.tff_backend.bizz.kyc import save_utility_bill
@@ -55,18 +57,18 @@ from plugins.tff_backend.bizz.service import get_main_branding_hash, add_user_to
 from plugins.tff_backend.bizz.todo import update_investor_progress
 from plugins.tff_backend.bizz.todo.investor import InvestorSteps
 from plugins.tff_backend.bizz.user import user_code, get_tff_profile
-from plugins.tff_backend.consts.kyc import country_choices
+from plugins.tff_backend.consts.kyc import COUNTRY_LABELS
 from plugins.tff_backend.consts.payment import TOKEN_TFT, TOKEN_ITFT
-from plugins.tff_backend.dal.investment_agreements import get_investment_agreement
-from plugins.tff_backend.models.global_stats import GlobalStats
-from plugins.tff_backend.models.investor import InvestmentAgreement, PaymentInfo
+from plugins.tff_backend.dal.investment_agreements import get_investment_agreement, get_investor_totals
+from plugins.tff_backend.models.investor import InvestmentAgreement, PaymentInfo, SignInvestmentReminder
 from plugins.tff_backend.models.user import KYCStatus, TffProfile
 from plugins.tff_backend.plugin_consts import KEY_ALGORITHM, KEY_NAME, \
     SUPPORTED_CRYPTO_CURRENCIES, CRYPTO_CURRENCY_NAMES, BUY_TOKENS_FLOW_V3, BUY_TOKENS_FLOW_V3_PAUSED, BUY_TOKENS_TAG, \
     BUY_TOKENS_FLOW_V3_KYC_MENTION, FLOW_CONFIRM_INVESTMENT, FLOW_INVESTMENT_CONFIRMED, FLOW_SIGN_INVESTMENT, \
     BUY_TOKENS_FLOW_V5, INVEST_FLOW_TAG, FLOW_HOSTER_REMINDER, SCHEDULED_QUEUE, FLOW_UTILITY_BILL_RECEIVED
 from plugins.tff_backend.to.investor import InvestmentAgreementTO, CreateInvestmentAgreementTO
-from plugins.tff_backend.utils import get_step_value, round_currency_amount, get_key_name_from_key_string, get_step
+from plugins.tff_backend.utils import get_step_value, round_currency_amount, get_key_name_from_key_string, get_step, \
+    StageTimer
 from plugins.tff_backend.utils.app import create_app_user_by_email, get_app_user_tuple, create_app_user
 
 INVESTMENT_TODO_MAPPING = {
@@ -76,6 +78,13 @@ INVESTMENT_TODO_MAPPING = {
     InvestmentAgreement.STATUS_PAID: InvestorSteps.ASSIGN_TOKENS,
 }
 
+# (seconds after the agreement was sent to the user, type of message)
+SIGN_INVESTMENT_REMINDERS = [
+    (3600, u'long'),
+    (3 * DAY, u'short'),
+    (10 * DAY, u'short'),
+]
+
 
 @returns(FlowMemberResultCallbackResultTO)
 @arguments(message_flow_run_id=unicode, member=unicode, steps=[object_factory("step_type", FLOW_STEP_MAPPING)],
@@ -168,7 +177,7 @@ def _create_investment_agreement(amount, currency, token, token_count_float, use
     name = '%s %s ' % (applicant.first_name, applicant.last_name)
     address = '%s %s' % (applicant.addresses[0].street, applicant.addresses[0].building_number)
     address += '\n%s %s' % (applicant.addresses[0].postcode, applicant.addresses[0].town)
-    country = filter(lambda c: c['value'] == applicant.addresses[0].country, country_choices)[0]['label']
+    country = COUNTRY_LABELS[applicant.addresses[0].country]
     address += '\n%s' % country
     precision = 2
     reference = user_code(username)
@@ -202,22 +211,20 @@ def create_investment_agreement(agreement):
                                                    sign_time=agreement.sign_time)
     prefix, doc_content_base64 = agreement.document.split(',')
     content_type = prefix.split(';')[0].replace('data:', '')
-    doc_content = base64.b64decode(doc_content_base64)
     agreement_model.put()
 
     pdf_name = InvestmentAgreement.filename(agreement_model.id)
-    upload_to_gcs(pdf_name, doc_content, content_type)
+    upload_base64_to_gcs(pdf_name, doc_content_base64, content_type)
     return agreement_model
 
 
 def get_currency_rate(currency):
-    global_stats = GlobalStats.create_key(TOKEN_TFT).get()  # type: GlobalStats
     if currency == 'USD':
-        return global_stats.value
-    currency_stats = filter(lambda c: c.currency == currency, global_stats.currencies)  # type: list[CurrencyValue]
-    if not currency_stats:
+        return get_cached_global_stats(TOKEN_TFT).value
+    value = get_cached_currency_value(TOKEN_TFT, currency)
+    if value is None:
         raise BusinessException('No stats are set for currency %s', currency)
-    return currency_stats[0].value
+    return value
 
 
 def get_investment_amount(currency, token_count):
@@ -247,7 +254,7 @@ def start_invest(email, tag, result_key, context, service_identity, user_details
 
 def _get_conversion_rates():
     result = []
-    stats = get_global_stats(TOKEN_ITFT)
+    stats = get_cached_global_stats(TOKEN_ITFT)
     for currency in stats.currencies:
         result.append({
             'name': _get_currency_name(currency.currency),
@@ -267,7 +274,7 @@ def invest_complete(message_flow_run_id, member, steps, end_id, end_message_flow
     app_id = user_details.app_id
     if 'confirm' in end_id:
         agreement_key = InvestmentAgreement.create_key(json.loads(tag)['investment_id'])
-        try_or_defer(_invest, agreement_key, email, app_id, 0)
+        deferred.defer(_invest, agreement_key, email, app_id)
 
 
 def _get_currency_name(currency):
@@ -278,16 +285,15 @@ def _get_currency_name(currency):
 
 def _set_token_count(agreement, token_count_float=None, precision=2):
     # type: (InvestmentAgreement, float, int) -> None
-    stats = get_global_stats(agreement.token)
     logging.info('Setting token count for agreement %s', agreement.to_dict())
     if agreement.status == InvestmentAgreement.STATUS_CREATED:
         if agreement.currency == 'USD':
-            agreement.token_count = long((agreement.amount / stats.value) * pow(10, precision))
+            value = get_cached_global_stats(agreement.token).value
         else:
-            currency_stats = filter(lambda s: s.currency == agreement.currency, stats.currencies)[0]
-            if not currency_stats:
+            value = get_cached_currency_value(agreement.token, agreement.currency)
+            if value is None:
                 raise HttpBadRequestException('Could not find currency conversion for currency %s' % agreement.currency)
-            agreement.token_count = long((agreement.amount / currency_stats.value) * pow(10, precision))
+        agreement.token_count = long((agreement.amount / value) * pow(10, precision))
     # token_count can be overwritten when marking the investment as paid for BTC
     elif agreement.status == InvestmentAgreement.STATUS_SIGNED:
         if agreement.currency == 'BTC':
@@ -304,24 +310,40 @@ def _set_token_count(agreement, token_count_float=None, precision=2):
 def _invest(agreement_key, email, app_id):
     # type: (ndb.Key, unicode, unicode) -> None
     from plugins.tff_backend.bizz.agreements import create_token_agreement_pdf
+    timer = StageTimer('Processing investment agreement %s' % agreement_key.id())
     app_user = create_app_user_by_email(email, app_id)
     logging.debug('Creating Token agreement')
-    agreement = get_investment_agreement(agreement_key.id())
+    agreement_future = agreement_key.get_async()
+    username = get_username(app_user)
+    # Prefetch the profile so get_tff_profile is served from the context cache
+    TffProfile.create_key(username).get_async()
+    agreement = agreement_future.get_result()  # type: InvestmentAgreement
+    if not agreement:
+        raise HttpNotFoundException('investment_agreement_not_found')
     _set_token_count(agreement)
-    agreement.put()
+    # The pdf doesn't depend on the token count, so store the agreement while the other data is being fetched
+    put_future = agreement.put_async()
     currency_full = _get_currency_name(agreement.currency)
     pdf_name = InvestmentAgreement.filename(agreement_key.id())
-    username = get_username(app_user)
     has_verified_utility_bill = get_tff_profile(username).kyc.utility_bill_verified
-    pdf_contents = create_token_agreement_pdf(agreement.name, agreement.address, agreement.amount, currency_full,
-                                              agreement.currency, agreement.token, agreement.payment_info,
-                                              has_verified_utility_bill)
-    pdf_url = upload_to_gcs(pdf_name, pdf_contents, 'application/pdf')
+    timer.mark('fetch')
     logging.debug('Storing Investment Agreement in the datastore')
-    pdf_size = len(pdf_contents)
+    put_future.get_result()
+    timer.mark('store_agreement')
+    render_args = [agreement.name, agreement.address, agreement.amount, currency_full, agreement.currency,
+                   agreement.token, agreement.payment_info, has_verified_utility_bill]
+    schedule_pdf_render(PdfType.TOKEN_AGREEMENT, agreement_key.id(), pdf_name, create_token_agreement_pdf, render_args,
+                        _token_agreement_pdf_rendered, [agreement_key, app_user, agreement.status])
+    timer.mark('schedule_render')
+    timer.log()
+
+
+def _token_agreement_pdf_rendered(agreement_key, app_user, status, pdf_url, pdf_size):
+    # type: (ndb.Key, users.User, int, unicode, long) -> None
+    email, app_id = get_app_user_tuple(app_user)
     attachment_name = u'Purchase Agreement - Internal Token Offering %s' % agreement_key.id()
     deferred.defer(_send_ito_agreement_sign_message, agreement_key, app_user, pdf_url, attachment_name, pdf_size)
-    deferred.defer(update_investor_progress, email, app_id, INVESTMENT_TODO_MAPPING[agreement.status])
+    deferred.defer(update_investor_progress, email.email(), app_id, INVESTMENT_TODO_MAPPING[status])
 
 
 def needs_utility_bill(agreement):
@@ -367,11 +389,7 @@ def _send_ito_agreement_sign_message(agreement_key, app_user, pdf_url, attachmen
     messaging.start_local_flow(get_mazraa_api_key(), None, members, None, tag=tag,
                                context=None, flow=FLOW_SIGN_INVESTMENT, flow_params=flow_params)
 
-    deferred.defer(_send_sign_investment_reminder, agreement_key.id(), u'long', _countdown=3600, _queue=SCHEDULED_QUEUE)
-    deferred.defer(_send_sign_investment_reminder, agreement_key.id(), u'short', _countdown=3 * DAY,
-                   _queue=SCHEDULED_QUEUE)
-    deferred.defer(_send_sign_investment_reminder, agreement_key.id(), u'short', _countdown=10 * DAY,
-                   _queue=SCHEDULED_QUEUE)
+    _schedule_sign_investment_reminders(agreement_key.id())
 
 
 def _send_ito_agreement_to_admin(agreement_key, admin_app_user):
@@ -558,13 +576,12 @@ def get_total_token_count(username, agreements):
 
 def get_total_investment_value(username):
     statuses = (InvestmentAgreement.STATUS_PAID, InvestmentAgreement.STATUS_SIGNED)
-    total_token_count = get_total_token_count(username, InvestmentAgreement.list_by_status_and_user(username, statuses))
+    total_token_count = get_investor_totals(username).get_token_counts(statuses)
+    logging.debug('%s has the following tokens: %s', username, total_token_count)
 
-    tokens = total_token_count.keys()
-    stats = dict(zip(tokens, ndb.get_multi([GlobalStats.create_key(token) for token in tokens])))
     total_usd = 0
     for token, token_count in total_token_count.iteritems():
-        total_usd += token_count * stats[token].value
+        total_usd += token_count * get_cached_global_stats(token).value
     logging.debug('The tokens of %s are worth $%s', username, total_usd)
     return total_usd
 
@@ -643,6 +660,52 @@ def get_intercom_tags_for_investment(agreement):
         return []
 
 
+@arguments(agreement_id=(int, long))
+def _schedule_sign_investment_reminders(agreement_id):
+    start_time = now()
+    SignInvestmentReminder(key=SignInvestmentReminder.create_key(agreement_id),
+                           start_time=start_time,
+                           reminder_index=0,
+                           next_reminder_time=start_time + SIGN_INVESTMENT_REMINDERS[0][0]).put()
+
+
+def send_sign_investment_reminders():
+    run_job(_get_due_sign_investment_reminders, [now()], _process_sign_investment_reminders, [], mode=MODE_BATCH,
+            batch_size=50)
+
+
+def _get_due_sign_investment_reminders(timestamp):
+    return SignInvestmentReminder.list_due(timestamp)
+
+
+def _process_sign_investment_reminders(reminder_keys):
+    agreements = ndb.get_multi([InvestmentAgreement.create_key(key.id()) for key in reminder_keys])
+    to_delete = []
+    for reminder_key, agreement in zip(reminder_keys, agreements):
+        if not agreement or agreement.status != InvestmentAgreement.STATUS_CREATED:
+            to_delete.append(reminder_key)
+        else:
+            _send_next_sign_investment_reminder(reminder_key)
+    if to_delete:
+        logging.debug('Removing reminders of %d agreements which are no longer waiting to be signed', len(to_delete))
+        ndb.delete_multi(to_delete)
+
+
+@ndb.transactional()
+def _send_next_sign_investment_reminder(reminder_key):
+    reminder = reminder_key.get()  # type: SignInvestmentReminder
+    if not reminder or reminder.next_reminder_time > now():
+        return
+    message_type = SIGN_INVESTMENT_REMINDERS[reminder.reminder_index][1]
+    deferred.defer(_send_sign_investment_reminder, reminder.agreement_id, message_type, _transactional=True)
+    reminder.reminder_index += 1
+    if reminder.reminder_index < len(SIGN_INVESTMENT_REMINDERS):
+        reminder.next_reminder_time = reminder.start_time + SIGN_INVESTMENT_REMINDERS[reminder.reminder_index][0]
+        reminder.put()
+    else:
+        reminder_key.delete()
+
+
 @returns()
 @arguments(agreement_id=(int, long), message_type=unicode)
 def _send_sign_investment_reminder(agreement_id, message_type):
@@ -667,6 +730,7 @@ def _send_sign_investment_reminder(agreement_id, message_type):
 # Called after the user his utility bill was approved
 def send_signed_investments_messages(app_user):
     username = get_username(app_user)
-    agreements = InvestmentAgreement.list_by_status_and_user(username, InvestmentAgreement.STATUS_SIGNED)
-    for agreement in agreements:
-        deferred.defer(send_payment_instructions, app_user, agreement.id, '')
+    agreement_keys = InvestmentAgreement.list_by_status_and_user(username, InvestmentAgreement.STATUS_SIGNED) \
+        .fetch(keys_only=True)
+    for agreement_key in agreement_keys:
+        deferred.defer(send_payment_instructions, app_user, agreement_key.id(), '')
@@ -15,21 +15,31 @@
 #
 # @@license_version:1.3@@
 
-from google.appengine.api import users
+from google.appengine.api import users, memcache
 from google.appengine.ext import ndb
 
 from framework.bizz.authentication import get_current_session
 from framework.models.session import Session
 from framework.plugin_loader import get_config, get_plugin
-from mcfw.cache import cached
 from mcfw.rpc import returns, arguments
 from plugins.its_you_online_auth.bizz.authentication import get_itsyouonline_client_from_jwt
 from plugins.its_you_online_auth.its_you_online_auth_plugin import ItsYouOnlineAuthPlugin
 from plugins.its_you_online_auth.plugin_consts import NAMESPACE as IYO_AUTH_NAMESPACE
 from plugins.rogerthat_api.to import UserDetailsTO
-from plugins.tff_backend.models.user import TffProfile
+from plugins.tff_backend.models.user import TffProfile, UsernameByAppUser, AppUserByUsername
+from plugins.tff_backend.plugin_consts import NAMESPACE
+from plugins.tff_backend.utils import LRUCache
 from plugins.tff_backend.utils.app import create_app_user_by_email
 
+USERNAME_CACHE_SIZE = 5000
+USERNAME_CACHE_TTL = 600  # seconds
+_USERNAME_MEMCACHE_PREFIX = 'username:'
+_APP_USER_MEMCACHE_PREFIX = 'app_user:'
+# upsert_tff_profile removes the mapping of the previous app user when a profile is linked to another app user.
+# Memcache and the datastore are updated right away, but the caches of other instances can't be invalidated,
+# so their entries expire after USERNAME_CACHE_TTL. get_app_user_from_iyo_username doesn't use this cache.
+_usernames_by_email = LRUCache(USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL)
+
 
 @returns(unicode)
 @arguments()
@@ -46,30 +56,158 @@ def get_username(app_user_or_user_details):
         app_user = create_app_user_by_email(app_user_or_user_details.email, app_user_or_user_details.app_id)
     else:
         app_user = app_user_or_user_details
+    username = _get_cached_username(app_user)
+    if username:
+        return username
     if 'itsyou.online' in app_user.email():
-        return get_iyo_plugin().get_username_from_rogerthat_email(app_user.email())
+        username = get_iyo_plugin().get_username_from_rogerthat_email(app_user.email())
     else:
-        return get_username_from_app_email(app_user)
+        username = get_username_from_app_email(app_user)
+    if username:
+        save_username_mapping(username, app_user)
+    return username
 
 
-@cached(1, 0)
 @returns(unicode)
 @arguments(app_user=users.User)
 def get_username_from_app_email(app_user):
     return TffProfile.get_by_app_user(app_user).username
 
 
+@ndb.non_transactional()
 @returns(dict)
 @arguments(app_emails=[unicode])
 def get_iyo_usernames(app_emails):
-    return get_iyo_plugin().get_usernames_from_rogerthat_emails(app_emails)
+    """
+    Resolves the usernames of many app users at once, using one memcache and one datastore call for all of them.
+    Only the app users which aren't in the username mapping yet are resolved one by one.
+    Returns:
+        dict: app email -> username, app emails which couldn't be resolved are omitted
+    """
+    usernames = {}
+    misses = []
+    for email in set(app_emails):
+        username = _usernames_by_email.get(email)
+        if username:
+            usernames[email] = username
+        else:
+            misses.append(email)
+    if misses:
+        found = memcache.get_multi(misses, key_prefix=_USERNAME_MEMCACHE_PREFIX, namespace=NAMESPACE)
+        misses = [email for email in misses if email not in found]
+        if misses:
+            mappings = ndb.get_multi([UsernameByAppUser.create_key(users.User(email)) for email in misses])
+            from_datastore = {email: mapping.username for email, mapping in zip(misses, mappings)
+                              if mapping and mapping.username}
+            if from_datastore:
+                memcache.set_multi(from_datastore, key_prefix=_USERNAME_MEMCACHE_PREFIX, namespace=NAMESPACE)
+            found.update(from_datastore)
+            misses = [email for email in misses if email not in from_datastore]
+        for email, username in found.iteritems():
+            _usernames_by_email.set(email, username)
+        usernames.update(found)
+    if misses:
+        resolved = {}
+        iyo_emails = [email for email in misses if 'itsyou.online' in email]
+        if iyo_emails:
+            resolved.update(get_iyo_plugin().get_usernames_from_rogerthat_emails(iyo_emails))
+        for email in misses:
+            if email not in iyo_emails:
+                profile = TffProfile.get_by_app_user(users.User(email))
+                resolved[email] = profile and profile.username
+        resolved = {email: username for email, username in resolved.iteritems() if username}
+        if resolved:
+            save_username_mappings(resolved)
+        usernames.update(resolved)
+    return usernames
 
 
+@ndb.non_transactional()
 @returns(users.User)
 @arguments(username=unicode)
 def get_app_user_from_iyo_username(username):
+    email = memcache.get(_APP_USER_MEMCACHE_PREFIX + username, namespace=NAMESPACE)
+    if not email:
+        mapping = AppUserByUsername.create_key(username).get()
+        email = mapping and mapping.app_user.email()
+        if email:
+            memcache.set(_APP_USER_MEMCACHE_PREFIX + username, email, namespace=NAMESPACE)
+    if email:
+        return users.User(email)
     email = get_iyo_plugin().get_rogerthat_email_from_username(username)
-    return email and users.User(email)
+    if not email:
+        return None
+    app_user = users.User(email)
+    save_username_mapping(username, app_user)
+    return app_user
+
+
+def _get_cached_username(app_user):
+    email = app_user.email()
+    username = _usernames_by_email.get(email)
+    if username:
+        return username
+    username = memcache.get(_USERNAME_MEMCACHE_PREFIX + email, namespace=NAMESPACE)
+    if not username:
+        mapping = UsernameByAppUser.create_key(app_user).get()
+        username = mapping and mapping.username
+        if not username:
+            return None
+        memcache.set(_USERNAME_MEMCACHE_PREFIX + email, username, namespace=NAMESPACE)
+    _usernames_by_email.set(email, username)
+    return username
+
+
+def create_username_mapping(username, app_user):
+    # type: (unicode, users.User) -> list[ndb.Model]
+    """Returns the (unsaved) models which map the username to the app user and the other way around.
+     Use update_username_cache after saving them to also update the caches."""
+    return [UsernameByAppUser(key=UsernameByAppUser.create_key(app_user), username=username),
+            AppUserByUsername(key=AppUserByUsername.create_key(username), app_user=app_user)]
+
+
+def get_stale_username_mapping_key(username, app_user, previous_app_user):
+    # type: (unicode, users.User, users.User) -> ndb.Key
+    """Returns the key of the UsernameByAppUser of previous_app_user when it still maps to this username,
+     but the username is now linked to another app user. The caller should delete it."""
+    if not previous_app_user or previous_app_user == app_user:
+        return None
+    key = UsernameByAppUser.create_key(previous_app_user)
+    mapping = key.get()
+    return key if mapping and mapping.username == username else None
+
+
+def update_username_cache(username, app_user, previous_app_user=None):
+    # type: (unicode, users.User, users.User) -> None
+    email = app_user.email()
+    memcache.set_multi({_USERNAME_MEMCACHE_PREFIX + email: username,
+                        _APP_USER_MEMCACHE_PREFIX + username: email}, namespace=NAMESPACE)
+    _usernames_by_email.set(email, username)
+    if previous_app_user and previous_app_user != app_user:
+        memcache.delete(_USERNAME_MEMCACHE_PREFIX + previous_app_user.email(), namespace=NAMESPACE)
+        _usernames_by_email.delete(previous_app_user.email())
+
+
+@ndb.non_transactional()
+def save_username_mapping(username, app_user):
+    # type: (unicode, users.User) -> None
+    ndb.put_multi(create_username_mapping(username, app_user))
+    update_username_cache(username, app_user)
+
+
+@ndb.non_transactional()
+def save_username_mappings(usernames):
+    # type: (dict[unicode, unicode]) -> None
+    """Saves and caches the username mapping of many app users. `usernames` maps app emails to usernames."""
+    to_put = []
+    for email, username in usernames.iteritems():
+        to_put.extend(create_username_mapping(username, users.User(email)))
+    ndb.put_multi(to_put)
+    memcache.set_multi(usernames, key_prefix=_USERNAME_MEMCACHE_PREFIX, namespace=NAMESPACE)
+    memcache.set_multi({username: email for email, username in usernames.iteritems()},
+                       key_prefix=_APP_USER_MEMCACHE_PREFIX, namespace=NAMESPACE)
+    for email, username in usernames.iteritems():
+        _usernames_by_email.set(email, username)
 
 
 @ndb.non_transactional()
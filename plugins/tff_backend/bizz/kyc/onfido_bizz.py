@@ -14,21 +14,30 @@
 # limitations under the License.
 #
 # @@license_version:1.3@@
+import hashlib
 import json
 import logging
+import uuid
 
-from google.appengine.api import urlfetch
+from google.appengine.api import urlfetch, taskqueue
+from google.appengine.ext import deferred, ndb
 
 import onfido
+from framework.consts import DAY
 from framework.plugin_loader import get_config
+from framework.utils import now
 from mcfw.consts import DEBUG
 from onfido import Applicant, Check
 from onfido.rest import ApiException
 from plugins.tff_backend.configuration import TffConfiguration
+from plugins.tff_backend.models.user import OnfidoApplicantCache, OnfidoCheckCache
 from plugins.tff_backend.plugin_consts import NAMESPACE
-from urllib3 import encode_multipart_formdata
+from urllib3.exceptions import HTTPError
 
 _client = None
+# Applicants only change when we update them, checks change when Onfido completes them
+APPLICANT_CACHE_TTL = DAY
+CHECKS_CACHE_TTL = 600
 
 
 def get_api_client():
@@ -47,18 +56,49 @@ def get_api_client():
 
 def get_applicant(applicant_id):
     # type: (str) -> Applicant
-    return get_api_client().find_applicant(applicant_id)
+    cached = _get_cache(OnfidoApplicantCache, applicant_id)  # type: OnfidoApplicantCache
+    if cached and cached.timestamp > now() - APPLICANT_CACHE_TTL:
+        return deserialize(cached.data, Applicant)
+    try:
+        applicant = get_api_client().find_applicant(applicant_id)
+    except (ApiException, HTTPError):
+        if not cached:
+            raise
+        logging.warning('Could not get applicant %s from Onfido, using cached version', applicant_id, exc_info=True)
+        return deserialize(cached.data, Applicant)
+    _save_cache(OnfidoApplicantCache, applicant_id, serialize(applicant))
+    return applicant
 
 
 def create_applicant(applicant):
     applicant.sandbox = DEBUG
-    return get_api_client().create_applicant(data=applicant)
+    result = get_api_client().create_applicant(data=applicant)
+    _save_cache(OnfidoApplicantCache, result.id, serialize(result))
+    return result
 
 
 def update_applicant(applicant_id, applicant):
     # type: (str, Applicant) -> Applicant
     applicant.sandbox = DEBUG
-    return get_api_client().update_applicant(applicant_id, data=applicant)
+    result = get_api_client().update_applicant(applicant_id, data=applicant)
+    _save_cache(OnfidoApplicantCache, applicant_id, serialize(result))
+    return result
+
+
+# The cache is kept outside of any transaction the onfido api is called in
+@ndb.non_transactional()
+def _get_cache(model_class, applicant_id):
+    return model_class.create_key(applicant_id).get()
+
+
+@ndb.non_transactional()
+def _save_cache(model_class, applicant_id, data):
+    model_class(key=model_class.create_key(applicant_id), data=data, timestamp=now()).put()
+
+
+@ndb.non_transactional()
+def _delete_cache(model_class, applicant_id):
+    model_class.create_key(applicant_id).delete()
 
 
 def list_applicants():
@@ -68,7 +108,34 @@ def list_applicants():
 def upload_document(applicant_id, document_type, document_url, side=None):
     # type: (str, str, str, str) -> onfido.Document
     logging.info('Downloading %s', document_url)
-    file_response = urlfetch.fetch(document_url)  # type: urlfetch._URLFetchResult
+    download_rpc = _fetch_async(document_url)
+    return _get_uploaded_document(_upload_document_async(applicant_id, document_type, side, download_rpc))
+
+
+def upload_documents(applicant_id, documents):
+    # type: (str, list[dict]) -> None
+    """
+    Schedules a task per document (dicts with type, value (url) and optionally side) of an applicant, so only one
+    document is kept in memory per request and a document that fails to upload is retried without the others.
+    """
+    for document in documents:
+        document_id = (u'%s-%s' % (applicant_id, document['value'])).encode('utf-8')
+        task_name = 'onfido-document-%s' % hashlib.sha1(document_id).hexdigest()
+        try:
+            deferred.defer(upload_document, applicant_id, document['type'], document['value'], document.get('side'),
+                           _name=task_name)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.info('Upload of document %s has already been scheduled', document['value'])
+
+
+def _fetch_async(url, payload=None, method=urlfetch.GET, headers=None):
+    rpc = urlfetch.create_rpc(deadline=60)
+    urlfetch.make_fetch_call(rpc, url, payload, method, headers or {})
+    return rpc
+
+
+def _upload_document_async(applicant_id, document_type, side, download_rpc):
+    file_response = download_rpc.get_result()  # type: urlfetch._URLFetchResult
     if file_response.status_code != 200:
         raise ApiException(file_response.status_code, file_response.content)
     content_type = file_response.headers.get('content-type', 'image/jpeg')
@@ -76,17 +143,10 @@ def upload_document(applicant_id, document_type, document_url, side=None):
         file_name = '%s.png' % document_type
     else:
         file_name = '%s.jpg' % document_type
-    return _upload_document(applicant_id, document_type, side, file_name, file_response.content, content_type)
-
-
-def _upload_document(applicant_id, document_type, side, file_name, file_content, content_type):
-    params = [
-        ('type', document_type),
-        ('file', (file_name, file_content, content_type)),
-    ]
+    fields = [('type', document_type)]
     if side:
-        params.append(('side', side))
-    payload, payload_content_type = encode_multipart_formdata(params)
+        fields.append(('side', side))
+    payload, payload_content_type = _encode_multipart_formdata(fields, file_name, file_response.content, content_type)
     client = get_api_client()
     headers = {
         'Authorization': onfido.configuration.get_api_key_with_prefix('Authorization'),
@@ -94,12 +154,30 @@ def _upload_document(applicant_id, document_type, side, file_name, file_content,
         'Accept': 'application/json'
     }
     url = '%s/applicants/%s/documents' % (client.api_client.host, applicant_id)
-    response = urlfetch.fetch(url, payload, urlfetch.POST, headers=headers)  # type: urlfetch._URLFetchResult
+    return _fetch_async(url, payload, urlfetch.POST, headers)
+
+
+def _get_uploaded_document(upload_rpc):
+    response = upload_rpc.get_result()  # type: urlfetch._URLFetchResult
     if response.status_code != 201:
         raise ApiException(response.status_code, response.content)
     return deserialize(json.loads(response.content), onfido.Document)
 
 
+def _encode_multipart_formdata(fields, file_name, file_content, content_type):
+    """Builds the request body with a single copy of the file, unlike urllib3's encode_multipart_formdata"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields:
+        parts.append((u'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                      % (boundary, name, value)).encode('utf-8'))
+    parts.append((u'--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\nContent-Type: %s\r\n\r\n'
+                  % (boundary, file_name, content_type)).encode('utf-8'))
+    parts.append(file_content)
+    parts.append('\r\n--%s--\r\n' % boundary)
+    return ''.join(parts), 'multipart/form-data; boundary=%s' % boundary
+
+
 def create_check(applicant_id):
     # type: (str) -> Check
     reports = [
@@ -110,6 +188,7 @@ def create_check(applicant_id):
     check = Check(type='express', reports=reports)
     result = get_api_client().create_check(applicant_id, data=check)
     logging.info('Check result from Onfido: %s', result)
+    _delete_cache(OnfidoCheckCache, applicant_id)
     return result
 
 
@@ -126,5 +205,16 @@ def deserialize(data, klass):
 
 def list_checks(applicant_id):
     # type: (str) -> list[onfido.Check]
-    # note that pagination does not work with this generated client
-    return get_api_client().list_checks(applicant_id).checks
+    cached = _get_cache(OnfidoCheckCache, applicant_id)  # type: OnfidoCheckCache
+    if cached and cached.timestamp > now() - CHECKS_CACHE_TTL:
+        return deserialize(cached.data, 'list[Check]')
+    try:
+        # note that pagination does not work with this generated client
+        checks = get_api_client().list_checks(applicant_id).checks
+    except (ApiException, HTTPError):
+        if not cached:
+            raise
+        logging.warning('Could not list checks of %s from Onfido, using cached version', applicant_id, exc_info=True)
+        return deserialize(cached.data, 'list[Check]')
+    _save_cache(OnfidoCheckCache, applicant_id, serialize(checks))
+    return checks
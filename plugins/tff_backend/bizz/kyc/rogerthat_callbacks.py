@@ -35,7 +35,7 @@ from plugins.rogerthat_api.to.messaging.service_callback_results import FlowMemb
 from plugins.tff_backend.bizz.email import send_emails_to_support
 from plugins.tff_backend.bizz.iyo.utils import get_username
 from plugins.tff_backend.bizz.kyc import save_utility_bill, validate_kyc_status
-from plugins.tff_backend.bizz.kyc.onfido_bizz import update_applicant, create_applicant, upload_document
+from plugins.tff_backend.bizz.kyc.onfido_bizz import update_applicant, create_applicant, upload_documents
 from plugins.tff_backend.bizz.rogerthat import create_error_message
 from plugins.tff_backend.bizz.user import get_tff_profile, generate_kyc_flow, set_kyc_status, index_tff_profile
 from plugins.tff_backend.models.user import KYCStatus, TffProfile
@@ -159,9 +159,8 @@ def _kyc_part_2(message_flow_run_id, member, steps, end_id, end_message_flow_id,
         if e.status in xrange(400, 499):
             raise BusinessException('Invalid status code from onfido: %s %s' % (e.status, e.body))
         raise
-    for document in documents:
-        deferred.defer(upload_document, applicant.id, document['type'], document['value'], document.get('side'),
-                       _transactional=True)
+    if documents:
+        deferred.defer(upload_documents, applicant.id, documents, _transactional=True)
     profile.kyc.set_status(KYCStatus.SUBMITTED.value, username)
     profile.put()
     deferred.defer(index_tff_profile, TffProfile.create_key(username))
@@ -38,8 +38,9 @@ from plugins.rogerthat_api.to.messaging.service_callback_results import TYPE_FLO
     FlowMemberResultCallbackResultTO
 from plugins.tff_backend.bizz import get_tf_token_api_key, get_grid_api_key
 from plugins.tff_backend.bizz.agreements import create_hosting_agreement_pdf
+from plugins.tff_backend.bizz.agreements.render import schedule_pdf_render, PdfType
 from plugins.tff_backend.bizz.email import send_emails_to_support
-from plugins.tff_backend.bizz.gcs import upload_to_gcs
+from plugins.tff_backend.bizz.gcs import upload_base64_to_gcs
 from plugins.tff_backend.bizz.intercom_helpers import tag_intercom_users, IntercomTags
 from plugins.tff_backend.bizz.iyo.utils import get_username
 from plugins.tff_backend.bizz.messages import send_message_and_email
@@ -52,6 +53,7 @@ from plugins.tff_backend.bizz.todo.hoster import HosterSteps
 from plugins.tff_backend.bizz.user import get_tff_profile
 from plugins.tff_backend.configuration import TffConfiguration
 from plugins.tff_backend.consts.hoster import REQUIRED_TOKEN_COUNT_TO_HOST
+from plugins.tff_backend.dal.investment_agreements import get_investor_totals
 from plugins.tff_backend.dal.node_orders import get_node_order
 from plugins.tff_backend.exceptions.hoster import OrderAlreadyExistsException, InvalidContentTypeException
 from plugins.tff_backend.models.hoster import NodeOrder, NodeOrderStatus, ContactInfo
@@ -149,8 +151,7 @@ def _order_node(order_key, user_email, app_id, steps):
         return
 
     # Check if user has invested >= 120 tokens
-    paid_orders = InvestmentAgreement.list_by_status_and_user(username, InvestmentAgreement.STATUS_PAID)
-    total_tokens = sum([o.token_count_float for o in paid_orders])
+    total_tokens = get_investor_totals(username).get_token_count([InvestmentAgreement.STATUS_PAID])
     can_host = total_tokens >= REQUIRED_TOKEN_COUNT_TO_HOST
 
     def trans():
@@ -182,12 +183,15 @@ def _order_node(order_key, user_email, app_id, steps):
 
 def _create_node_order_pdf(node_order_id, app_user):
     node_order = get_node_order(node_order_id)
-    user_email, app_id = get_app_user_tuple(app_user)
     logging.debug('Creating Hosting agreement')
     pdf_name = NodeOrder.filename(node_order_id)
-    pdf_contents = create_hosting_agreement_pdf(node_order.billing_info.name, node_order.billing_info.address)
-    pdf_size = len(pdf_contents)
-    pdf_url = upload_to_gcs(pdf_name, pdf_contents, 'application/pdf')
+    schedule_pdf_render(PdfType.HOSTING_AGREEMENT, node_order_id, pdf_name, create_hosting_agreement_pdf,
+                        [node_order.billing_info.name, node_order.billing_info.address], _node_order_pdf_rendered,
+                        [node_order_id, app_user])
+
+
+def _node_order_pdf_rendered(node_order_id, app_user, pdf_url, pdf_size):
+    user_email, app_id = get_app_user_tuple(app_user)
     deferred.defer(_order_node_iyo_see, app_user, node_order_id, pdf_url, pdf_size)
     deferred.defer(update_hoster_progress, user_email.email(), app_id, HosterSteps.FLOW_ADDRESS)
 
@@ -464,15 +468,15 @@ def create_node_order(data):
     if content_type != 'application/pdf':
         raise InvalidContentTypeException(content_type, ['application/pdf'])
 
-    doc_content = base64.b64decode(doc_content_base64)
     order_key = NodeOrder.create_key()
     pdf_name = NodeOrder.filename(order_key.id())
-    pdf_url = upload_to_gcs(pdf_name, doc_content, content_type)
+    pdf_url = upload_base64_to_gcs(pdf_name, doc_content_base64, content_type)
     order = NodeOrder(key=order_key,
                       **data.to_dict(exclude=['document']))
     order.put()
     deferred.defer(assign_nodes_to_user, order.username, nodes)
     deferred.defer(set_hoster_status_in_user_data, profile.app_user, False)
     deferred.defer(tag_intercom_users, IntercomTags.HOSTER, [order.username])
-    deferred.defer(_order_node_iyo_see, profile.app_user, order.id, pdf_url, len(doc_content), create_quotation=False)
+    pdf_size = len(doc_content_base64) * 3 / 4 - doc_content_base64[-2:].count('=')
+    deferred.defer(_order_node_iyo_see, profile.app_user, order.id, pdf_url, pdf_size, create_quotation=False)
     return order
@@ -15,72 +15,108 @@
 #
 # @@license_version:1.3@@
 
+import bisect
 import time
+from collections import defaultdict
 
 from google.appengine.api import users
 from google.appengine.ext import ndb
 
 from framework.utils import now
 from mcfw.rpc import returns, arguments
-from plugins.rogerthat_api.exceptions import BusinessException
 from plugins.tff_backend.models.payment import ThreeFoldTransaction, ThreeFoldPendingTransaction
 from plugins.tff_backend.to.payment import WalletBalanceTO
 
 
-def _get_balance_from_transactions(transactions, token):
-    # type: (list[ThreeFoldTransaction], unicode) -> WalletBalanceTO
-    available_balance = 0
-    total_balance = 0
-    total_description_details = []
-    # TODO set to minimum precision of all transactions when transactions have the 'precision' property
-    # (and multiply available / total amount depending on precision)
-    precision = 2
-    # for transaction in transactions:
-    #     precision = max(transaction.precision, precision)
+class TokenBalance(object):
+    """
+    Balance of one token, calculated in a single pass over the unspent transactions of a user.
+    All unlocks are kept in sorted parallel lists, so the unlocked amount at any time can be found by bisecting.
+    """
 
-    for transaction in transactions:
-        if transaction.token != token:
-            raise BusinessException('Invalid transaction supplied to _get_balance_from_transactions. '
-                                    'All transactions must have %s as token', token)
-        amount_spent = transaction.amount - transaction.amount_left
+    def __init__(self, token, transactions):
+        # type: (unicode, list[ThreeFoldTransaction]) -> None
+        self.token = token
+        # TODO set to minimum precision of all transactions when transactions have the 'precision' property
+        # (and multiply available / total amount depending on precision)
+        self.precision = 2
+        self.total = 0
+        self.spent = 0
+        unlocks = []
+        for transaction in transactions:
+            self.spent += transaction.amount - transaction.amount_left
+            self.total += transaction.amount_left
+            unlocks.extend(zip(transaction.unlock_timestamps, transaction.unlock_amounts))
+        unlocks.sort()
+        self.unlock_timestamps = [timestamp for timestamp, _ in unlocks]
+        self.unlock_amounts = [amount for _, amount in unlocks]
+        # Total amount unlocked up to and including each unlock
+        self.unlocked_amounts = []
         unlocked_amount = 0
-        now_ = now()
-        for unlock_timestamp, unlock_amount in zip(transaction.unlock_timestamps, transaction.unlock_amounts):
-            if unlock_timestamp <= now_:
-                unlocked_amount += unlock_amount
-            else:
-                total_description_details.append((unlock_timestamp, unlock_amount))
+        for amount in self.unlock_amounts:
+            unlocked_amount += amount
+            self.unlocked_amounts.append(unlocked_amount)
+
+    def _get_unlocked_count(self, timestamp):
+        return bisect.bisect_right(self.unlock_timestamps, timestamp)
 
-        spendable_amount = unlocked_amount - amount_spent
+    def get_available(self, timestamp):
+        unlocked_count = self._get_unlocked_count(timestamp)
+        unlocked_amount = self.unlocked_amounts[unlocked_count - 1] if unlocked_count else 0
+        return unlocked_amount - self.spent
 
-        available_balance += spendable_amount
-        total_balance += transaction.amount_left
-    if total_description_details:
-        total_description = u"""##  %(token)s Unlock times'
+    def get_description(self, timestamp):
+        unlocked_count = self._get_unlocked_count(timestamp)
+        if unlocked_count == len(self.unlock_timestamps):
+            return None
+        lines = [u"""##  %(token)s Unlock times'
 
 |Date|#%(token)s|
 |---|---:|
-        """ % {'token': token}
-        for unlock_timestamp, unlock_amount in sorted(total_description_details, key=lambda tup: tup[0]):
+        """ % {'token': self.token}]
+        for unlock_timestamp, unlock_amount in zip(self.unlock_timestamps[unlocked_count:],
+                                                   self.unlock_amounts[unlocked_count:]):
             date = time.strftime('%a %d %b %Y %H:%M:%S GMT', time.localtime(unlock_timestamp))
             amount = u'{:0,.2f}'.format(unlock_amount / 100.0)
-            total_description += u'\n|%s|%s|' % (date, amount)
-    else:
-        total_description = None
-    return WalletBalanceTO(available=available_balance, total=total_balance, description=total_description, token=token,
-                           precision=precision)
+            lines.append(u'|%s|%s|' % (date, amount))
+        return u'\n'.join(lines)
+
+    def to_wallet_balance(self, timestamp, include_description=True):
+        # type: (int, bool) -> WalletBalanceTO
+        description = self.get_description(timestamp) if include_description else None
+        return WalletBalanceTO(available=self.get_available(timestamp), total=self.total, description=description,
+                               token=self.token, precision=self.precision)
+
+
+def get_token_balances(transactions):
+    # type: (list[ThreeFoldTransaction]) -> dict[unicode, TokenBalance]
+    transactions_per_token = defaultdict(list)
+    for transaction in transactions:
+        transactions_per_token[transaction.token].append(transaction)
+    return {token: TokenBalance(token, token_transactions)
+            for token, token_transactions in transactions_per_token.iteritems()}
 
 
 @returns([WalletBalanceTO])
 @arguments(username=unicode)
 def get_all_balances(username):
-    transactions = ThreeFoldTransaction.list_with_amount_left(username)
-    token_types = set(map(lambda transaction: transaction.token, transactions))
-    results = []
-    for token in token_types:
-        transactions_per_token = [trans for trans in transactions if trans.token == token]
-        results.append(_get_balance_from_transactions(transactions_per_token, token))
-    return results
+    return get_balances([username])[username]
+
+
+def get_balances(usernames):
+    # type: (list[unicode]) -> dict[unicode, list[WalletBalanceTO]]
+    """Gets the balances of multiple users, querying the transactions of all users in parallel."""
+    now_ = now()
+    futures = [ThreeFoldTransaction.list_with_amount_left(username).fetch_async() for username in usernames]
+    return {username: [balance.to_wallet_balance(now_) for balance in get_token_balances(future.get_result()).values()]
+            for username, future in zip(usernames, futures)}
+
+
+def list_token_holder_balances(cursor, page_size):
+    # type: (unicode, int) -> tuple[dict[unicode, list[WalletBalanceTO]], ndb.Cursor, bool]
+    results, cursor, more = ThreeFoldTransaction.list_holders() \
+        .fetch_page(page_size, start_cursor=ndb.Cursor(urlsafe=cursor))
+    return get_balances([transaction.to_username for transaction in results]), cursor, more
 
 
 @returns(tuple)
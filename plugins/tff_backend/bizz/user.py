@@ -34,6 +34,7 @@ from framework.i18n_utils import DEFAULT_LANGUAGE, translate
 from framework.plugin_loader import get_config
 from framework.utils import try_or_defer
 from framework.utils.jinja_extensions import TranslateExtension
+from mcfw.cache import cached
 from mcfw.consts import MISSING, DEBUG
 from mcfw.exceptions import HttpNotFoundException, HttpBadRequestException
 from mcfw.rpc import returns, arguments
@@ -48,12 +49,13 @@ from plugins.rogerthat_api.to.system import RoleTO
 from plugins.tff_backend.bizz import get_tf_token_api_key, get_mazraa_api_key
 from plugins.tff_backend.bizz.intercom_helpers import upsert_intercom_user, tag_intercom_users, IntercomTags, \
     get_intercom_plugin
-from plugins.tff_backend.bizz.iyo.utils import get_username
+from plugins.tff_backend.bizz.iyo.utils import get_username, create_username_mapping, update_username_cache, \
+    get_stale_username_mapping_key
 from plugins.tff_backend.bizz.kyc.onfido_bizz import create_check, update_applicant, deserialize, list_checks, serialize
 from plugins.tff_backend.bizz.messages import send_message_and_email
 from plugins.tff_backend.bizz.rogerthat import create_error_message, send_rogerthat_message, put_user_data
 from plugins.tff_backend.bizz.service import get_main_branding_hash
-from plugins.tff_backend.consts.kyc import kyc_steps, DEFAULT_KYC_STEPS, REQUIRED_DOCUMENT_TYPES
+from plugins.tff_backend.consts.kyc import REQUIRED_DOCUMENT_TYPES, KYC_STEPS_BY_TYPE, KYC_PROPERTIES_PER_COUNTRY
 from plugins.tff_backend.models.user import ProfilePointer, TffProfile, KYCInformation, KYCStatus, TffProfileInfo
 from plugins.tff_backend.plugin_consts import NAMESPACE, KYC_FLOW_PART_1, KYC_FLOW_PART_1_TAG, \
     BUY_TOKENS_TAG
@@ -71,6 +73,11 @@ FLOWS_JINJA_ENVIRONMENT = jinja2.Environment(
 
 TFF_PROFILE_INDEX = search.Index('tff_profile', namespace=NAMESPACE)
 
+# Increment when kyc_steps or the kyc_part_2 flow change, so cached flows are no longer used
+KYC_FLOW_VERSION = 1
+# Known information that differs per user, filled in after rendering the cached flow of a country
+KYC_USER_PROPERTIES = ('first_name', 'last_name', 'email', 'dob')
+
 
 def create_tff_profile(user_details):
     # type: (UserDetailsTO) -> TffProfile
@@ -214,6 +221,7 @@ def upsert_tff_profile(username, user_details):
         }
         deferred.defer(put_user_data, get_tf_token_api_key(), user_details.email, user_details.app_id, user_data,
                        _transactional=True)
+    previous_app_user = profile.app_user
     profile.app_user = create_app_user_by_email(user_details.email, user_details.app_id)
     profile.info = TffProfileInfo(name=user_details.name,
                                   language=user_details.language,
@@ -221,7 +229,12 @@ def upsert_tff_profile(username, user_details):
     if 'itsyou.online' not in user_details.email:
         profile.info.email = user_details.email
     to_put.append(profile)
+    to_put.extend(create_username_mapping(username, profile.app_user))
     ndb.put_multi(to_put)
+    stale_mapping_key = get_stale_username_mapping_key(username, profile.app_user, previous_app_user)
+    if stale_mapping_key:
+        stale_mapping_key.delete()
+    update_username_cache(username, profile.app_user, previous_app_user)
     index_tff_profile(profile)
     return profile
 
@@ -299,23 +312,41 @@ def send_kyc_flow(app_user, message=None):
 def generate_kyc_flow(nationality, country, iyo_username):
     logging.info('Generating KYC flow for user %s and country %s', iyo_username, nationality)
     flow_params = {'nationality': nationality, 'country': country}
-    properties = DEFAULT_KYC_STEPS.union(_get_extra_properties(country))
     try:
         known_information = _get_known_information(iyo_username)
-        known_information['address_country'] = country
     except HttpNotFoundException:
         logging.error('No profile found for user %s!', iyo_username)
         return create_error_message()
+    xml = _get_kyc_flow_skeleton(country, get_main_branding_hash())
+    for prop in KYC_USER_PROPERTIES:
+        value = known_information.get(prop) or (_get_step_info(prop) or {}).get('value') or ''
+        xml = xml.replace(_get_kyc_value_placeholder(prop), unicode(jinja2.escape(value)))
+    return xml, flow_params
+
+
+def _get_kyc_value_placeholder(prop):
+    return u'__kyc_value_%s__' % prop
 
+
+@cached(version=KYC_FLOW_VERSION, lifetime=86400, request=True, memcache=True)
+@returns(unicode)
+@arguments(country=unicode, branding_key=unicode)
+def _get_kyc_flow_skeleton(country, branding_key):
+    """
+    Renders the KYC flow for a country, with placeholders for the values that differ per user (see
+    KYC_USER_PROPERTIES). These are filled in by generate_kyc_flow.
+    The branding key is an argument so the cached flow is rendered again when the branding changes.
+    """
+    properties = KYC_PROPERTIES_PER_COUNTRY[country]
+    known_information = {'address_country': country}
     steps = []
-    branding_key = get_main_branding_hash()
     must_ask_passport = 'passport' not in REQUIRED_DOCUMENT_TYPES[country]
     must_ask_passport = False
     for prop in properties:
         step_info = _get_step_info(prop)
         if not step_info:
             raise BusinessException('Unsupported step type: %s' % prop)
-        value = known_information.get(prop)
+        value = _get_kyc_value_placeholder(prop) if prop in KYC_USER_PROPERTIES else known_information.get(prop)
         reference = 'message_%s' % prop
         # If yes, go to passport step. If no, go to national identity step
         if prop in ('national_identity_card', 'national_identity_card_front') and must_ask_passport:
@@ -369,16 +400,11 @@ Note: If you do not have a passport (and only a national id), you will only be a
         'branding_key': branding_key,
         'has_passport_step': has_passport_step
     }
-    return FLOWS_JINJA_ENVIRONMENT.get_template('kyc_part_2.xml').render(template_params), flow_params
-
-
-def _get_extra_properties(country_code):
-    return REQUIRED_DOCUMENT_TYPES[country_code]
+    return FLOWS_JINJA_ENVIRONMENT.get_template('kyc_part_2.xml').render(template_params)
 
 
 def _get_step_info(property):
-    results = filter(lambda step: step['type'] == property, kyc_steps)
-    return results[0] if results else None
+    return KYC_STEPS_BY_TYPE.get(property)
 
 
 def _get_known_information(username):
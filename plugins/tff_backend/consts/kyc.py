@@ -714,3 +714,10 @@ REQUIRED_DOCUMENT_TYPES = {
     u'ZMB': ['passport'],
     u'ZWE': ['passport']
 }
+
+# Lookup tables, so callers don't have to scan the lists above
+COUNTRY_LABELS = {country['value']: country['label'] for country in country_choices}
+KYC_STEPS_BY_TYPE = {step['type']: step for step in kyc_steps}
+# Properties that have to be asked in the KYC flow, per country of residence
+KYC_PROPERTIES_PER_COUNTRY = {country: frozenset(DEFAULT_KYC_STEPS.union(document_types))
+                              for country, document_types in REQUIRED_DOCUMENT_TYPES.iteritems()}
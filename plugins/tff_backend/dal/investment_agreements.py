@@ -26,11 +26,13 @@ from mcfw.exceptions import HttpNotFoundException
 from mcfw.rpc import returns, arguments
 from plugins.tff_backend.bizz.iyo.utils import get_username, get_iyo_usernames
 from plugins.tff_backend.consts.investor import INVESTMENT_AGREEMENT_SEARCH_INDEX
-from plugins.tff_backend.models.investor import InvestmentAgreement
+from plugins.tff_backend.models.investor import InvestmentAgreement, InvestorTotals
 from plugins.tff_backend.plugin_consts import NAMESPACE
 from plugins.tff_backend.utils.search import remove_all_from_index
 
 INVESTMENT_INDEX = search.Index(INVESTMENT_AGREEMENT_SEARCH_INDEX, namespace=NAMESPACE)
+# Statuses of the agreements of which the token counts are used, see get_investor_totals
+TOTALS_STATUSES = (InvestmentAgreement.STATUS_SIGNED, InvestmentAgreement.STATUS_PAID)
 
 
 @returns(InvestmentAgreement)
@@ -106,3 +108,47 @@ def search_investment_agreements(query=None, page_size=20, cursor=None):
 
 def list_investment_agreements_by_user(username):
     return InvestmentAgreement.list_by_user(username)
+
+
+def get_investor_totals(username):
+    # type: (unicode) -> InvestorTotals
+    totals_key = InvestorTotals.create_key(username)
+    totals = totals_key.get()
+    if not totals:
+        # Only needed until all totals have been created by migration 019
+        totals = InvestorTotals(key=totals_key)
+        for status, agreement in _list_token_counts_by_user(username):
+            totals.set_agreement(agreement.id, agreement.token, status, agreement.token_count_float)
+    return totals
+
+
+@ndb.non_transactional()
+def _list_token_counts_by_user(username):
+    # type: (unicode) -> list[tuple[int, InvestmentAgreement]]
+    # Not an ancestor query, so it can't run in the transaction of update_investor_totals.
+    # Agreements with other statuses aren't counted, they are added to the totals when they are signed.
+    futures = [(status, InvestmentAgreement.list_token_counts_by_user(username, status).fetch_async())
+               for status in TOTALS_STATUSES]
+    return [(status, agreement) for status, future in futures for agreement in future.get_result()]
+
+
+@ndb.transactional(xg=True)
+def update_investor_totals(agreement_key):
+    # type: (ndb.Key) -> None
+    agreement = agreement_key.get()  # type: InvestmentAgreement
+    if not agreement or not agreement.username:
+        return
+    totals = get_investor_totals(agreement.username)
+    totals.set_agreement(agreement.id, agreement.token, agreement.status, agreement.token_count_float)
+    totals.put()
+
+
+def investment_agreement_updated(agreement_key):
+    # type: (ndb.Key) -> None
+    """Updates the search index and the investor totals with the current version of the agreement"""
+    agreement = agreement_key.get()  # type: InvestmentAgreement
+    if not agreement:
+        return
+    index_investment_agreement(agreement)
+    if agreement.username:
+        update_investor_totals(agreement_key)
@@ -29,8 +29,10 @@ from plugins.rogerthat_api.api import friends
 from plugins.tff_backend.bizz import get_tf_token_api_key
 from plugins.tff_backend.bizz.agenda import update_expired_events
 from plugins.tff_backend.bizz.dashboard import rebuild_firebase_data
-from plugins.tff_backend.bizz.flow_statistics import check_stuck_flows
+from plugins.tff_backend.bizz.flow_statistics import check_stuck_flows, export_flow_statistics
 from plugins.tff_backend.bizz.global_stats import update_currencies
+from plugins.tff_backend.bizz.investment_stats import aggregate_investment_agreements
+from plugins.tff_backend.bizz.investor import send_sign_investment_reminders
 from plugins.tff_backend.bizz.nodes.stats import save_node_statuses, check_online_nodes, check_offline_nodes
 from plugins.tff_backend.configuration import TffConfiguration
 from plugins.tff_backend.plugin_consts import NAMESPACE
@@ -130,3 +132,21 @@ class CheckStuckFlowsHandler(webapp2.RequestHandler):
 
     def get(self):
         check_stuck_flows()
+
+
+class ExportFlowStatisticsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        export_flow_statistics()
+
+
+class AggregateInvestmentAgreementsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        aggregate_investment_agreements()
+
+
+class SignInvestmentRemindersHandler(webapp2.RequestHandler):
+
+    def get(self):
+        send_sign_investment_reminders()
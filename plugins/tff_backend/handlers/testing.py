@@ -15,11 +15,20 @@
 #
 # @@license_version:1.3@@
 
+import random
+import time
+
 import webapp2
 
-from plugins.tff_backend.bizz.agreements import create_hosting_agreement_pdf, create_token_agreement_pdf
+from plugins.tff_backend.bizz.agreements import create_hosting_agreement_pdf, create_token_agreement_pdf, \
+    create_itft_amendment_1_pdf
 from plugins.tff_backend.bizz.investor import _get_currency_name
-from plugins.tff_backend.consts.payment import TOKEN_TFT
+from plugins.tff_backend.bizz.payment import get_token_balances
+from plugins.tff_backend.bizz.user import generate_kyc_flow
+from plugins.tff_backend.consts.kyc import country_choices, kyc_steps, DEFAULT_KYC_STEPS, REQUIRED_DOCUMENT_TYPES, \
+    COUNTRY_LABELS, KYC_STEPS_BY_TYPE, KYC_PROPERTIES_PER_COUNTRY
+from plugins.tff_backend.consts.payment import TOKEN_TFT, TOKEN_ITFT
+from plugins.tff_backend.models.payment import ThreeFoldTransaction
 
 
 class AgreementsTestingPageHandler(webapp2.RequestHandler):
@@ -43,3 +52,109 @@ class AgreementsTestingPageHandler(webapp2.RequestHandler):
         self.response.headers['Content-Type'] = 'application/pdf'
         self.response.headers['Content-Disposition'] = str('inline; filename=testing.pdf')
         self.response.out.write(pdf)
+
+
+class BalancesBenchmarkHandler(webapp2.RequestHandler):
+    """Calculates the balances of a user with lots of synthetic transactions"""
+
+    def get(self, *args, **kwargs):
+        transaction_count = int(self.request.get('transactions', 10000))
+        unlocks_per_transaction = int(self.request.get('unlocks', 4))
+        now_ = int(time.time())
+        transactions = []
+        for _ in xrange(transaction_count):
+            amount = random.randint(1, 100000) * unlocks_per_transaction
+            transactions.append(ThreeFoldTransaction(
+                token=random.choice([TOKEN_TFT, TOKEN_ITFT]),
+                amount=amount,
+                amount_left=amount - random.randint(0, amount / 2),
+                unlock_timestamps=[now_ + random.randint(-365, 365) * 86400 for _ in xrange(unlocks_per_transaction)],
+                unlock_amounts=[amount / unlocks_per_transaction] * unlocks_per_transaction))
+
+        start = time.time()
+        balances = get_token_balances(transactions)
+        results = [balance.to_wallet_balance(now_, include_description=False) for balance in balances.itervalues()]
+        balance_duration = time.time() - start
+        start = time.time()
+        for balance in balances.itervalues():
+            balance.get_description(now_)
+        description_duration = time.time() - start
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('%d transactions, %d unlocks each\n' % (transaction_count, unlocks_per_transaction))
+        self.response.out.write('Balances: %.1f ms\n' % (balance_duration * 1000))
+        self.response.out.write('Descriptions: %.1f ms\n' % (description_duration * 1000))
+        for result in results:
+            self.response.out.write('%s: available %d, total %d\n' % (result.token, result.available, result.total))
+
+
+class AgreementsBenchmarkHandler(webapp2.RequestHandler):
+    """Renders every type of agreement a number of times and reports the average duration per pdf"""
+
+    def get(self, *args, **kwargs):
+        iterations = int(self.request.get('iterations', 5))
+        name = u'__NAME__'
+        address = u'__ADDRESS__'
+        amount = 123.456789123456789
+        renderers = [
+            ('hosting', lambda: create_hosting_agreement_pdf(name, address)),
+        ]
+        for token, currency in ((TOKEN_TFT, u'USD'), (TOKEN_TFT, u'BTC'), (TOKEN_ITFT, u'USD'), (TOKEN_ITFT, u'EUR')):
+            renderers.append(('%s %s' % (token, currency),
+                              lambda t=token, c=currency: create_token_agreement_pdf(
+                                  name, address, amount, _get_currency_name(c), c, t, payment_info=None,
+                                  has_verified_utility_bill=True)))
+        # The amendment is based on the agreements of an existing user
+        username = self.request.get('username')
+        if username:
+            renderers.append(('iTFT amendment 1', lambda: create_itft_amendment_1_pdf(username)))
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('%d iterations\n' % iterations)
+        for pdf_type, render in renderers:
+            start = time.time()
+            first_duration = None
+            for i in xrange(iterations):
+                pdf = render()
+                if i == 0:
+                    first_duration = time.time() - start
+            duration = time.time() - start
+            self.response.out.write('%s: first %.1f ms, average %.1f ms, %d bytes\n' % (
+                pdf_type, first_duration * 1000, duration * 1000 / iterations, len(pdf)))
+
+
+class KycLookupsBenchmarkHandler(webapp2.RequestHandler):
+    """Compares scanning the KYC country and step lists with the lookup tables, for every supported country"""
+
+    def get(self, *args, **kwargs):
+        iterations = int(self.request.get('iterations', 10))
+        # Unsupported countries have required documents but can't be chosen
+        countries = sorted(country for country in REQUIRED_DOCUMENT_TYPES if country in COUNTRY_LABELS)
+
+        def scan():
+            for country in countries:
+                filter(lambda c: c['value'] == country, country_choices)[0]['label']
+                for prop in DEFAULT_KYC_STEPS.union(REQUIRED_DOCUMENT_TYPES[country]):
+                    filter(lambda step: step['type'] == prop, kyc_steps)[0]
+
+        def lookup():
+            for country in countries:
+                COUNTRY_LABELS[country]
+                for prop in KYC_PROPERTIES_PER_COUNTRY[country]:
+                    KYC_STEPS_BY_TYPE[prop]
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('%d countries, %d iterations\n' % (len(countries), iterations))
+        for name, function in (('Scanning lists', scan), ('Lookup tables', lookup)):
+            start = time.time()
+            for _ in xrange(iterations):
+                function()
+            self.response.out.write('%s: %.3f ms per iteration\n' % (name, (time.time() - start) * 1000 / iterations))
+        # Generating the entire flow requires an existing profile
+        username = self.request.get('username')
+        if username:
+            start = time.time()
+            for country in countries:
+                generate_kyc_flow(country, country, username)
+            self.response.out.write('Generating KYC flows: %.1f ms per country\n' % (
+                (time.time() - start) * 1000 / len(countries)))
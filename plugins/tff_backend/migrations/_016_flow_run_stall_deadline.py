@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.4@@
+from google.appengine.ext import ndb
+
+from framework.bizz.job import run_job
+from plugins.tff_backend.bizz.flow_statistics import FLOW_STALL_TIMEOUT
+from plugins.tff_backend.models.statistics import FlowRun, FlowRunStatus
+
+
+def migrate():
+    run_job(_get_flow_runs_in_progress, [], _set_stall_deadline, [])
+
+
+def _get_flow_runs_in_progress():
+    return FlowRun.query(FlowRun.status == FlowRunStatus.IN_PROGRESS)
+
+
+@ndb.transactional()
+def _set_stall_deadline(flow_run_key):
+    flow_run = flow_run_key.get()  # type: FlowRun
+    if flow_run.status != FlowRunStatus.IN_PROGRESS or flow_run.stall_deadline:
+        return
+    flow_run.stall_deadline = flow_run.statistics.last_step_date + FLOW_STALL_TIMEOUT
+    flow_run.put()
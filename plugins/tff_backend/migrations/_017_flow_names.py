@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.4@@
+from google.appengine.ext import ndb
+
+from mcfw.cache import invalidate_cache
+from plugins.tff_backend.bizz.flow_statistics import list_distinct_flows
+from plugins.tff_backend.models.statistics import FlowRun, FlowName
+
+
+def migrate():
+    flow_names = FlowRun.list_distinct_flows()
+    ndb.put_multi([FlowName(key=FlowName.create_key(flow_name)) for flow_name in flow_names])
+    invalidate_cache(list_distinct_flows)
+    return flow_names
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.4@@
+from google.appengine.ext import ndb
+
+from framework.bizz.job import run_job, MODE_BATCH
+from plugins.tff_backend.models.statistics import FlowRun, FlowRunSummary
+
+
+def migrate():
+    run_job(_get_flow_runs, [], _create_summaries, [], mode=MODE_BATCH, batch_size=50)
+
+
+def _get_flow_runs():
+    return FlowRun.query()
+
+
+def _create_summaries(flow_run_keys):
+    summary_keys = [FlowRunSummary.create_key(key.id()) for key in flow_run_keys]
+    existing = {key for key, summary in zip(summary_keys, ndb.get_multi(summary_keys)) if summary}
+    to_put = [FlowRunSummary.from_flow_run(flow_run) for flow_run in ndb.get_multi(flow_run_keys)
+              if flow_run and FlowRunSummary.create_key(flow_run.id) not in existing]
+    ndb.put_multi(to_put)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.4@@
+from framework.bizz.job import run_job
+from plugins.tff_backend.dal.investment_agreements import update_investor_totals
+from plugins.tff_backend.models.investor import InvestmentAgreement
+
+
+def migrate():
+    run_job(_get_investment_agreements, [], _update_totals, [])
+
+
+def _get_investment_agreements():
+    return InvestmentAgreement.query()
+
+
+def _update_totals(agreement_key):
+    update_investor_totals(agreement_key)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.4@@
+from google.appengine.ext import ndb
+
+from framework.bizz.job import run_job, MODE_BATCH
+from plugins.tff_backend.models.investor import InvestmentAgreement
+
+
+def migrate():
+    run_job(_get_investment_agreements, [], _reindex_agreements, [], mode=MODE_BATCH, batch_size=50)
+
+
+def _get_investment_agreements():
+    return InvestmentAgreement.query()
+
+
+def _reindex_agreements(agreement_keys):
+    # Saving the agreements again indexes token, token_count and token_precision
+    agreements = [agreement for agreement in ndb.get_multi(agreement_keys) if agreement]
+    for agreement in agreements:
+        # The agreement itself doesn't change
+        agreement.keep_modification_time = True
+    ndb.put_multi(agreements)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.4@@
+from google.appengine.ext import ndb
+
+from framework.bizz.job import run_job, MODE_BATCH
+from plugins.tff_backend.bizz.iyo.utils import create_username_mapping
+from plugins.tff_backend.models.user import TffProfile
+
+
+def migrate():
+    run_job(_get_profiles, [], _create_username_mappings, [], mode=MODE_BATCH, batch_size=100)
+
+
+def _get_profiles():
+    return TffProfile.query()
+
+
+def _create_username_mappings(profile_keys):
+    to_put = []
+    for profile in ndb.get_multi(profile_keys):  # type: TffProfile
+        if profile and profile.app_user:
+            to_put.extend(create_username_mapping(profile.username, profile.app_user))
+    ndb.put_multi(to_put)
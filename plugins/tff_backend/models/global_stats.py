@@ -38,6 +38,10 @@ class GlobalStats(NdbModel):
     currencies = ndb.LocalStructuredProperty(CurrencyValue, repeated=True)  # type: list[CurrencyValue]
     market_cap = ndb.ComputedProperty(lambda self: (self.value or 0) * self.unlocked_count, indexed=False)
 
+    def _post_put_hook(self, future):
+        from plugins.tff_backend.bizz.global_stats import invalidate_global_stats_cache
+        invalidate_global_stats_cache()
+
     @property
     def id(self):
         return self.key.id().decode('utf-8')
@@ -49,3 +53,18 @@ class GlobalStats(NdbModel):
     @classmethod
     def list(cls):
         return cls.query()
+
+
+class CurrencyRates(NdbModel):
+    """Exchange rates fetched from an external source. Keys are currencies, values the price of 1 USD."""
+    NAMESPACE = NAMESPACE
+    rates = ndb.JsonProperty(compressed=True)  # type: dict[unicode, float]
+    timestamp = ndb.IntegerProperty(indexed=False)
+
+    @property
+    def source(self):
+        return self.key.id()
+
+    @classmethod
+    def create_key(cls, source):
+        return ndb.Key(cls, source, namespace=NAMESPACE)
@@ -26,10 +26,11 @@ class InvestmentAgreement(NdbModel):
     app_user = ndb.UserProperty()  # todo: remove after migration 014
     username = ndb.StringProperty()
     amount = ndb.FloatProperty(indexed=False)
-    token = ndb.StringProperty(indexed=False, default=TOKEN_TFT)
+    # token, token_count and token_precision are indexed to allow projection queries
+    token = ndb.StringProperty(default=TOKEN_TFT)
     token_count_float = ndb.ComputedProperty(_compute_token_count, indexed=False)  # Real amount of tokens
-    token_count = ndb.IntegerProperty(indexed=False, default=0)  # amount of tokens x 10 ^ token_precision
-    token_precision = ndb.IntegerProperty(indexed=False, default=0)
+    token_count = ndb.IntegerProperty(default=0)  # amount of tokens x 10 ^ token_precision
+    token_precision = ndb.IntegerProperty(default=0)
     currency = ndb.StringProperty(indexed=False)
     name = ndb.StringProperty(indexed=False)
     address = ndb.StringProperty(indexed=False)
@@ -48,16 +49,24 @@ class InvestmentAgreement(NdbModel):
     version = ndb.StringProperty()
     payment_info = ndb.IntegerProperty(repeated=True, choices=map(int, PaymentInfo))
 
+    # Set to True to save the agreement without changing its modification time, e.g. when only reindexing it
+    keep_modification_time = False
+
     def _pre_put_hook(self):
-        self.modification_time = now()
+        if not self.keep_modification_time:
+            self.modification_time = now()
 
     def _post_put_hook(self, future):
-        from plugins.tff_backend.dal.investment_agreements import index_investment_agreement
+        from plugins.tff_backend.dal.investment_agreements import index_investment_agreement, \
+            update_investor_totals, investment_agreement_updated
         if ndb.in_transaction():
             from google.appengine.ext import deferred
-            deferred.defer(index_investment_agreement, self, _transactional=True)
+            # Only the key is passed, so tasks that run out of order still use the latest version of the agreement
+            deferred.defer(investment_agreement_updated, self.key, _transactional=True)
         else:
             index_investment_agreement(self)
+            if self.username:
+                update_investor_totals(self.key)
 
     @property
     def id(self):
@@ -86,9 +95,129 @@ class InvestmentAgreement(NdbModel):
 
     @classmethod
     def list_by_status_and_user(cls, username, statuses):
-        # type: (unicode, list[int]) -> list[InvestmentAgreement]
+        # type: (unicode, list[int]) -> ndb.Query
         statuses = [statuses] if isinstance(statuses, int) else statuses
-        return [investment for investment in cls.list_by_user(username) if investment.status in statuses]
+        return cls.query() \
+            .filter(cls.username == username) \
+            .filter(cls.status.IN(statuses))
+
+    @classmethod
+    def list_modified_since(cls, timestamp):
+        return cls.query(cls.modification_time >= timestamp)
+
+    @classmethod
+    def list_token_counts_by_user(cls, username, status):
+        # type: (unicode, int) -> ndb.Query
+        """Projection query, only token, token_count and token_precision (and thus token_count_float) are set"""
+        return cls.query(cls.username == username, cls.status == status,
+                         projection=[cls.token, cls.token_count, cls.token_precision])
 
     def to_dict(self, extra_properties=[], include=None, exclude=None):
         return super(InvestmentAgreement, self).to_dict(extra_properties + ['document_url'], include, exclude)
+
+
+class InvestorTotals(NdbModel):
+    """
+    Token counts of the investment agreements of a user.
+    Stored per agreement so that saving an agreement multiple times doesn't change the totals.
+    """
+    NAMESPACE = NAMESPACE
+    # agreement id -> {'token': unicode, 'status': int, 'token_count': float}
+    agreements = ndb.JsonProperty()  # type: dict[str, dict]
+
+    @property
+    def username(self):
+        return self.key.id()
+
+    @classmethod
+    def create_key(cls, username):
+        return ndb.Key(cls, username, namespace=NAMESPACE)
+
+    def set_agreement(self, agreement_id, token, status, token_count):
+        if self.agreements is None:
+            self.agreements = {}
+        self.agreements[str(agreement_id)] = {
+            'token': token,
+            'status': status,
+            'token_count': token_count,
+        }
+
+    def get_token_counts(self, statuses):
+        # type: (list[int]) -> dict[unicode, float]
+        token_counts = {}
+        for agreement in (self.agreements or {}).itervalues():
+            if agreement['status'] in statuses:
+                token_counts[agreement['token']] = token_counts.get(agreement['token'], 0) + agreement['token_count']
+        return token_counts
+
+    def get_token_count(self, statuses):
+        # type: (list[int]) -> float
+        """Amount of tokens of all types"""
+        return sum(self.get_token_counts(statuses).itervalues())
+
+
+class SignInvestmentReminder(NdbModel):
+    """Reminder(s) to sign an investment agreement that still have to be sent. Key id is the agreement id."""
+    NAMESPACE = NAMESPACE
+    start_time = ndb.IntegerProperty(indexed=False)
+    reminder_index = ndb.IntegerProperty(indexed=False, default=0)
+    next_reminder_time = ndb.IntegerProperty()
+
+    @property
+    def agreement_id(self):
+        return self.key.id()
+
+    @classmethod
+    def create_key(cls, agreement_id):
+        return ndb.Key(cls, agreement_id, namespace=NAMESPACE)
+
+    @classmethod
+    def list_due(cls, timestamp):
+        return cls.query(cls.next_reminder_time <= timestamp)
+
+
+class InvestmentAgreementTotals(NdbModel):
+    token = ndb.StringProperty(indexed=False)
+    currency = ndb.StringProperty(indexed=False)
+    status = ndb.IntegerProperty(indexed=False)
+    agreement_count = ndb.IntegerProperty(indexed=False)
+    amount = ndb.FloatProperty(indexed=False)
+    token_count = ndb.FloatProperty(indexed=False)
+
+
+class InvestmentAgreementDailyStats(NdbModel):
+    """Totals per token, currency and status of the investment agreements created on one day"""
+    NAMESPACE = NAMESPACE
+    date = ndb.DateProperty()
+    # agreement id -> [token, currency, status, amount, token_count], so updating an agreement twice has no effect
+    agreements = ndb.JsonProperty(compressed=True)  # type: dict[str, list]
+    totals = ndb.LocalStructuredProperty(InvestmentAgreementTotals,
+                                         repeated=True)  # type: list[InvestmentAgreementTotals]
+
+    @classmethod
+    def create_key(cls, date):
+        return ndb.Key(cls, date.isoformat(), namespace=NAMESPACE)
+
+    @classmethod
+    def list_by_date(cls, start_date, end_date):
+        return cls.query() \
+            .filter(cls.date >= start_date) \
+            .filter(cls.date <= end_date) \
+            .order(cls.date)
+
+    def set_agreement(self, agreement_id, token, currency, status, amount, token_count):
+        if self.agreements is None:
+            self.agreements = {}
+        self.agreements[str(agreement_id)] = [token, currency, status, amount, token_count]
+
+    def update_totals(self):
+        totals = {}
+        for token, currency, status, amount, token_count in self.agreements.itervalues():
+            key = (token, currency, status)
+            if key not in totals:
+                totals[key] = InvestmentAgreementTotals(token=token, currency=currency, status=status,
+                                                        agreement_count=0, amount=0.0, token_count=0.0)
+            totals[key].agreement_count += 1
+            totals[key].amount += amount
+            totals[key].token_count += token_count
+        self.totals = [total for _, total in sorted(totals.iteritems())]
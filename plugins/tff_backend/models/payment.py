@@ -56,6 +56,10 @@ class ThreeFoldTransaction(ThreeFoldBaseTransaction):
             .filter(cls.fully_spent == False) \
             .order(-cls.timestamp)  # noQA
 
+    @classmethod
+    def list_holders(cls):
+        return cls.query(cls.fully_spent == False, projection=[cls.to_username], group_by=[cls.to_username])  # noQA
+
 
 class ThreeFoldPendingTransaction(ThreeFoldBaseTransaction):
     STATUS_PENDING = u'pending'
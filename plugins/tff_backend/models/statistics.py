@@ -14,6 +14,8 @@
 # limitations under the License.
 #
 # @@license_version:1.4@@
+from datetime import datetime
+
 from google.appengine.ext import ndb
 
 from enum import IntEnum
@@ -53,6 +55,8 @@ class FlowRun(NdbModel):
     steps = ndb.JsonProperty(repeated=True, compressed=True)
     tag = ndb.StringProperty()
     user = ndb.StringProperty()
+    # Only set while the flow is in progress. Once passed, the flow run is considered stalled.
+    stall_deadline = ndb.DateTimeProperty()
 
     @property
     def id(self):
@@ -79,13 +83,23 @@ class FlowRun(NdbModel):
             .filter(cls.start_date > start_date) \
             .order(-cls.start_date)
 
+    @classmethod
+    def list_by_start_date_range(cls, start_date, end_date):
+        return cls.query() \
+            .filter(cls.start_date >= start_date) \
+            .filter(cls.start_date < end_date) \
+            .order(cls.start_date)
+
     @classmethod
     def list_distinct_flows(cls):
         return [f.flow_name for f in cls.query(projection=[cls.flow_name], group_by=[cls.flow_name]).fetch()]
 
     @classmethod
-    def list_by_status_and_last_step_date(cls, status, date):
-        return cls.query().filter(cls.status == status).filter(cls.statistics.last_step_date < date)
+    def list_by_stall_deadline(cls, date):
+        # Lower bound excludes flow runs without deadline, as null sorts before any date
+        return cls.query() \
+            .filter(cls.stall_deadline > datetime.utcfromtimestamp(0)) \
+            .filter(cls.stall_deadline < date)
 
     @classmethod
     def list_by_user(cls, user):
@@ -94,3 +108,61 @@ class FlowRun(NdbModel):
     @classmethod
     def list_by_user_and_flow(cls, flow_name, user):
         return cls.query(cls.flow_name == flow_name, cls.user == user).order(-cls.start_date)
+
+
+class FlowRunSummary(NdbModel):
+    """Copy of a FlowRun without its steps, used for listing flow runs. Has the same id as the FlowRun."""
+    NAMESPACE = NAMESPACE
+    flow_name = ndb.StringProperty(indexed=False)
+    start_date = ndb.DateTimeProperty(indexed=False)
+    status = ndb.IntegerProperty(indexed=False, choices=FLOW_RUN_STATUSES)
+    statistics = ndb.LocalStructuredProperty(FlowRunStatistics)  # type: FlowRunStatistics
+    tag = ndb.StringProperty(indexed=False)
+    user = ndb.StringProperty(indexed=False)
+
+    @property
+    def id(self):
+        return self.key.id()
+
+    @classmethod
+    def create_key(cls, flow_run_id):
+        return ndb.Key(cls, flow_run_id, namespace=cls.NAMESPACE)
+
+    @classmethod
+    def from_flow_run(cls, flow_run):
+        # type: (FlowRun) -> FlowRunSummary
+        return cls(key=cls.create_key(flow_run.id),
+                   flow_name=flow_run.flow_name,
+                   start_date=flow_run.start_date,
+                   status=flow_run.status,
+                   statistics=flow_run.statistics,
+                   tag=flow_run.tag,
+                   user=flow_run.user)
+
+
+class FlowName(NdbModel):
+    """Registry of all flows for which a FlowRun exists"""
+    NAMESPACE = NAMESPACE
+
+    @property
+    def name(self):
+        return self.key.id()
+
+    @classmethod
+    def create_key(cls, flow_name):
+        return ndb.Key(cls, flow_name, namespace=cls.NAMESPACE)
+
+    @classmethod
+    def list(cls):
+        return cls.query()
+
+
+class LatestFlowRun(NdbModel):
+    """Points to the most recent run of a flow by a user"""
+    NAMESPACE = NAMESPACE
+    flow_run_key = ndb.KeyProperty(indexed=False)
+    start_date = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def create_key(cls, flow_name, user):
+        return ndb.Key(cls, u'%s:%s' % (user, flow_name), namespace=cls.NAMESPACE)
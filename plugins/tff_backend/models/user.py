@@ -119,3 +119,45 @@ class ProfilePointer(NdbModel):
     @classmethod
     def get_by_user_code(cls, user_code):
         return ndb.Key(cls, user_code, namespace=NAMESPACE).get()
+
+
+class OnfidoApplicantCache(NdbModel):
+    """Serialized applicant as last received from Onfido. Key id is the applicant id."""
+    NAMESPACE = NAMESPACE
+    data = ndb.JsonProperty(compressed=True)
+    timestamp = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def create_key(cls, applicant_id):
+        return ndb.Key(cls, applicant_id, namespace=NAMESPACE)
+
+
+class OnfidoCheckCache(NdbModel):
+    """Serialized checks of an applicant as last received from Onfido. Key id is the applicant id."""
+    NAMESPACE = NAMESPACE
+    data = ndb.JsonProperty(compressed=True)
+    timestamp = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def create_key(cls, applicant_id):
+        return ndb.Key(cls, applicant_id, namespace=NAMESPACE)
+
+
+class UsernameByAppUser(NdbModel):
+    """Key id is the email of the app user"""
+    NAMESPACE = NAMESPACE
+    username = ndb.StringProperty(indexed=False)
+
+    @classmethod
+    def create_key(cls, app_user):
+        return ndb.Key(cls, app_user.email(), namespace=NAMESPACE)
+
+
+class AppUserByUsername(NdbModel):
+    """Key id is the username"""
+    NAMESPACE = NAMESPACE
+    app_user = ndb.UserProperty(indexed=False)
+
+    @classmethod
+    def create_key(cls, username):
+        return ndb.Key(cls, username, namespace=NAMESPACE)
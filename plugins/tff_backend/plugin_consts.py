@@ -50,3 +50,5 @@ FF_ENDED_TIMESTAMP = 1517785200  # friends and family sale
 
 SCHEDULED_QUEUE = 'scheduled-queue'
 INTERCOM_QUEUE = 'intercom'
+FLOW_STATISTICS_QUEUE = 'flow-statistics'
+PDF_RENDER_QUEUE = 'pdf-render'
@@ -17,8 +17,6 @@
 import json
 import logging
 
-from google.appengine.ext import deferred
-
 from framework.plugin_loader import get_config
 from framework.utils import try_or_defer
 from mcfw.properties import object_factory
@@ -42,7 +40,7 @@ from plugins.tff_backend.api.rogerthat.referrals import api_set_referral
 from plugins.tff_backend.bizz import get_mazraa_api_key
 from plugins.tff_backend.bizz.authentication import RogerthatRoles
 from plugins.tff_backend.bizz.dashboard import update_firebase_installation
-from plugins.tff_backend.bizz.flow_statistics import save_flow_statistics
+from plugins.tff_backend.bizz.flow_statistics import queue_flow_statistics
 from plugins.tff_backend.bizz.global_stats import ApiCallException
 from plugins.tff_backend.bizz.intercom_helpers import upsert_intercom_user
 from plugins.tff_backend.bizz.investor import invest_tft, invest_itft, investment_agreement_signed, \
@@ -111,8 +109,8 @@ def flow_member_result(rt_settings, request_id, message_flow_run_id, member, ste
         else:
             logging.info('[tff] Ignoring flow_member_result with tag %s and flush_id %s', tag, flush_id)
     finally:
-        deferred.defer(save_flow_statistics, parent_message_key, steps, end_id, tag, flush_id, flush_message_flow_id,
-                       user_details, timestamp, result)
+        queue_flow_statistics(parent_message_key, steps, end_id, tag, flush_id, flush_message_flow_id, user_details,
+                              timestamp, result)
 
 
 def form_update(rt_settings, request_id, status, form_result, answer_id, member, message_key, tag, received_timestamp,
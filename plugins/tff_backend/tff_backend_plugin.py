@@ -30,9 +30,11 @@ from plugins.tff_backend.bizz.statistics import log_restapi_call_result
 from plugins.tff_backend.configuration import TffConfiguration
 from plugins.tff_backend.handlers.cron import RebuildSyncedRolesHandler, UpdateGlobalStatsHandler, \
     SaveNodeStatusesHandler, BackupHandler, CheckNodesOnlineHandler, ExpiredEventsHandler, RebuildFirebaseHandler, \
-    CheckOfflineNodesHandler, CheckStuckFlowsHandler
+    CheckOfflineNodesHandler, CheckStuckFlowsHandler, ExportFlowStatisticsHandler, \
+    AggregateInvestmentAgreementsHandler, SignInvestmentRemindersHandler
 from plugins.tff_backend.handlers.index import IndexPageHandler
-from plugins.tff_backend.handlers.testing import AgreementsTestingPageHandler
+from plugins.tff_backend.handlers.testing import AgreementsTestingPageHandler, BalancesBenchmarkHandler, \
+    AgreementsBenchmarkHandler, KycLookupsBenchmarkHandler
 from plugins.tff_backend.handlers.update_app import UpdateAppPageHandler
 from plugins.tff_backend.patch_onfido_lib import patch_onfido_lib
 
@@ -80,6 +82,14 @@ class TffBackendPlugin(BrandingPlugin):
             yield Handler(url='/admin/cron/tff_backend/events/expired', handler=ExpiredEventsHandler)
             yield Handler(url='/admin/cron/tff_backend/check_stuck_flows', handler=CheckStuckFlowsHandler)
             yield Handler(url='/admin/cron/tff_backend/rebuild_firebase', handler=RebuildFirebaseHandler)
+            yield Handler(url='/admin/cron/tff_backend/export_flow_statistics', handler=ExportFlowStatisticsHandler)
+            yield Handler(url='/admin/cron/tff_backend/aggregate_investment_agreements',
+                          handler=AggregateInvestmentAgreementsHandler)
+            yield Handler(url='/admin/cron/tff_backend/sign_investment_reminders',
+                          handler=SignInvestmentRemindersHandler)
+            yield Handler(url='/admin/tff_backend/benchmarks/balances', handler=BalancesBenchmarkHandler)
+            yield Handler(url='/admin/tff_backend/benchmarks/agreements', handler=AgreementsBenchmarkHandler)
+            yield Handler(url='/admin/tff_backend/benchmarks/kyc', handler=KycLookupsBenchmarkHandler)
 
     def get_client_routes(self):
         return ['/orders<route:.*>', '/node-orders<route:.*>', '/investment-agreements<route:.*>',
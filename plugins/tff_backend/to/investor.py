@@ -21,7 +21,7 @@ from google.appengine.ext import ndb
 
 from framework.to import TO
 from mcfw.properties import long_property, unicode_property, typed_property, float_property
-from plugins.tff_backend.models.investor import InvestmentAgreement
+from plugins.tff_backend.models.investor import InvestmentAgreement, InvestmentAgreementDailyStats
 from plugins.tff_backend.to import PaginatedResultTO
 from plugins.tff_backend.to.iyo.see import IYOSeeDocument
 
@@ -93,3 +93,23 @@ class InvestmentAgreementListTO(PaginatedResultTO):
         assert isinstance(cursor, (search.Cursor, NoneType))
         orders = [InvestmentAgreementTO.from_model(model) for model in models]
         return cls(cursor and cursor.web_safe_string.decode('utf-8'), more, orders)
+
+
+class InvestmentAgreementTotalsTO(TO):
+    token = unicode_property('token')
+    currency = unicode_property('currency')
+    status = long_property('status')
+    agreement_count = long_property('agreement_count')
+    amount = float_property('amount')
+    token_count = float_property('token_count')
+
+
+class InvestmentAgreementDailyStatsTO(TO):
+    date = unicode_property('date')
+    totals = typed_property('totals', InvestmentAgreementTotalsTO, True)
+
+    @classmethod
+    def from_model(cls, model):
+        # type: (InvestmentAgreementDailyStats) -> InvestmentAgreementDailyStatsTO
+        return cls(date=model.date.isoformat().decode('utf-8'),
+                   totals=[InvestmentAgreementTotalsTO.from_model(totals) for totals in model.totals])
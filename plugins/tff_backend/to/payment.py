@@ -125,3 +125,16 @@ class WalletBalanceTO(TO):
     description = unicode_property('description')
     token = unicode_property('token')
     precision = long_property('precision')
+
+
+class UserBalancesTO(TO):
+    username = unicode_property('username')
+    balances = typed_property('balances', WalletBalanceTO, True)
+
+
+class UserBalancesListTO(PaginatedResultTO):
+    results = typed_property('results', UserBalancesTO, True)
+
+
+class BalancesQueryTO(TO):
+    usernames = unicode_list_property('usernames')
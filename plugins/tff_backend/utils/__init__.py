@@ -16,7 +16,11 @@
 # @@license_version:1.3@@
 
 import json
+import logging
 import re
+import threading
+import time
+from collections import OrderedDict
 
 from google.appengine.ext import db
 
@@ -90,3 +94,53 @@ def get_key_name_from_key_string(key_string):
         return db.Key(key_string).name()
     except db.BadArgumentError:
         return key_string
+
+
+class StageTimer(object):
+    """Measures how long each stage of a multi-step process takes and logs the result"""
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self._start = self._last = time.time()
+
+    def mark(self, stage):
+        now_ = time.time()
+        self.stages.append((stage, now_ - self._last))
+        self._last = now_
+
+    def log(self):
+        stages = ', '.join('%s: %dms' % (stage, duration * 1000) for stage, duration in self.stages)
+        logging.info('%s took %dms (%s)', self.name, (self._last - self._start) * 1000, stages)
+
+
+class LRUCache(object):
+    """Thread safe dict which forgets the least recently used items once it contains more than max_size items.
+     When ttl is set, items are also forgotten ttl seconds after they were set."""
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, expires_at = self._items.pop(key)
+            if expires_at and expires_at < time.time():
+                return default
+            self._items[key] = value, expires_at
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value, self.ttl and time.time() + self.ttl
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)